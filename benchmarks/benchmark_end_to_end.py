@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+from types import SimpleNamespace
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import uvicorn
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from search_agent import vlm_rag_agent
+from tracing import TRACER
+import stub_vlm_server
+
+"""
+Offline end-to-end benchmark of vlm_rag_agent (no GPU, Google or Wikipedia needed)
+ - VLM       : benchmarks/stub_vlm_server.py (same API as Phi3_Vision_Server, configurable latency / scripted responses)
+ - web       : a local HTTP server replaying recorded search results and Wikipedia pages
+               (search tool 1 = recorded Google results page, search tool 2 = recorded json list)
+ - retriever : any small HF encoder (--retriever_model_id), e.g. a tiny random BERT for pure pipeline overhead
+Every question of the workload (jsonl, "question" or "title" field per line) is a full SEARCH turn in its own session.
+Reports per-question and per-stage (tracing.py spans) latency percentiles and the throughput.
+With --baseline, exits with status 1 if a p50 latency regressed by more than --max_regression compared to a previous
+--output file.
+
+fixtures_dir layout (built from --corpus, e.g. parsed_search_results.json, when not given)
+    search_tool_1.html   search_tool_2.json   image.jpg   pages/<article>.html
+    ({BASE_URL} in these files is replaced by the address of the local server)
+
+`python benchmarks/benchmark_end_to_end.py --workload requests.jsonl --retriever_model_id hf-internal-testing/tiny-random-BertModel`
+"""
+
+def build_fixtures(directory, corpus_path):
+    with open(corpus_path, 'r', encoding='utf-8') as file:
+        corpus = json.load(file)
+    pages = {}
+    for passage in corpus:
+        pages.setdefault((passage['Title'], passage['URL']), []).append(passage['content'])
+
+    os.makedirs(os.path.join(directory, 'pages'), exist_ok=True)
+    results = []
+    for (title, url), paragraphs in pages.items():
+        article = url.rstrip('/').split('/')[-1]
+        body = "".join(f"<p>{paragraph}</p>" for paragraph in paragraphs)
+        with open(os.path.join(directory, 'pages', f"{article}.html"), 'w', encoding='utf-8') as file:
+            file.write(f"<html><body><div id='mw-content-text'>{body}</div></body></html>")
+        results.append({'page_title': title, 'page_url': f"{{BASE_URL}}/en.wikipedia.org/wiki/{article}"})
+
+    # the google results page also lists non-Wikipedia results (filtered out by the scraper), 10 results in total
+    google_results = results + [{'page_title': f"Travel blog {i}", 'page_url': f"{{BASE_URL}}/blog/{i}"} for i in range(max(0, 10 - len(results)))]
+    with open(os.path.join(directory, 'search_tool_1.html'), 'w', encoding='utf-8') as file:
+        file.write("<html><body>" + "".join(f"<div class='g'><a href='{result['page_url']}'><h3>{result['page_title']}</h3></a></div>" for result in google_results) + "</body></html>")
+    with open(os.path.join(directory, 'search_tool_2.json'), 'w', encoding='utf-8') as file:
+        json.dump(results, file)
+    Image.new('RGB', (640, 480), (90, 140, 200)).save(os.path.join(directory, 'image.jpg'))
+
+def start_fixture_server(directory, latency_ms):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency_ms / 1000) # simulated network latency
+            path = self.path.split('?')[0]
+            if path == '/searchbyimage':
+                file_path, content_type = os.path.join(directory, 'search_tool_1.html'), 'text/html; charset=utf-8'
+            elif path.startswith('/en.wikipedia.org/wiki/'):
+                file_path, content_type = os.path.join(directory, 'pages', f"{path.split('/')[-1]}.html"), 'text/html; charset=utf-8'
+            else:
+                file_path, content_type = os.path.join(directory, path.lstrip('/')), 'image/jpeg'
+            if not os.path.isfile(file_path):
+                self.send_error(404)
+                return
+            with open(file_path, 'rb') as file:
+                body = file.read()
+            if content_type.startswith('text/html'):
+                body = body.replace(b'{BASE_URL}', base_url.encode('utf-8'))
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, base_url
+
+# search tool 2 (google_img_source_search) replaced by its recorded results
+class Recorded_Search_Tool():
+    def __init__(self, results_path, base_url):
+        with open(results_path, 'r', encoding='utf-8') as file:
+            self.results = [SimpleNamespace(page_title=result['page_title'], page_url=result['page_url'].replace('{BASE_URL}', base_url)) for result in json.load(file)]
+
+    def search(self, image_url):
+        return list(self.results)
+
+def start_stub_vlm_server():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(stub_vlm_server.app, host='127.0.0.1', port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, f"http://127.0.0.1:{port}"
+
+def load_workload(path, num_questions):
+    questions = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                questions.append(record.get('question') or record['title'])
+    return questions[:num_questions] if num_questions else questions
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+def summarize(values):
+    return {'p50': percentile(values, 50), 'p90': percentile(values, 90), 'p99': percentile(values, 99), 'mean': sum(values) / len(values), 'count': len(values)}
+
+# total duration (ms) of every span name within one chat turn (e.g. all vlm_call spans of the turn)
+def stage_durations(span, durations=None):
+    durations = defaultdict(float) if durations is None else durations
+    durations[span.name] += 1000 * span.duration
+    for child in span.children:
+        stage_durations(child, durations)
+    return durations
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workload', type=str, default='requests.jsonl')
+    parser.add_argument('--num_questions', type=int, default=None)
+    parser.add_argument('--concurrency', type=int, default=1, help='questions answered at once (one session each)')
+    parser.add_argument('--fixtures_dir', type=str, default=None)
+    parser.add_argument('--corpus', type=str, default='parsed_search_results.json')
+    parser.add_argument('--web_latency_ms', type=float, default=50)
+    parser.add_argument('--vlm_prefill_ms', type=float, default=stub_vlm_server.CONFIG['prefill_ms'])
+    parser.add_argument('--vlm_ms_per_token', type=float, default=stub_vlm_server.CONFIG['ms_per_token'])
+    parser.add_argument('--vlm_concurrency', type=int, default=stub_vlm_server.CONFIG['concurrency'])
+    parser.add_argument('--context_token_budget', type=int, default=1536, help='token budget of a packed VLM call, 0 = one passage per call')
+    parser.add_argument('--retriever_model_id', type=str, default='facebook/contriever')
+    parser.add_argument('--output', type=str, default=None, help='write the results to this json file')
+    parser.add_argument('--baseline', type=str, default=None, help='results json of a previous run to compare against')
+    parser.add_argument('--max_regression', type=float, default=0.2)
+    args = parser.parse_args()
+
+    workload = load_workload(os.path.abspath(args.workload), args.num_questions)
+    stub_vlm_server.CONFIG.update(prefill_ms=args.vlm_prefill_ms, ms_per_token=args.vlm_ms_per_token, concurrency=args.vlm_concurrency)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        fixtures_dir = os.path.abspath(args.fixtures_dir) if args.fixtures_dir else os.path.join(work_dir, 'fixtures')
+        if args.fixtures_dir is None:
+            build_fixtures(fixtures_dir, os.path.abspath(args.corpus))
+        web_server, web_url = start_fixture_server(fixtures_dir, args.web_latency_ms)
+        vlm_server, vlm_url = start_stub_vlm_server()
+
+        # the scraper cache and passage store of the agent start empty (created in the working directory)
+        os.chdir(work_dir)
+        agent = vlm_rag_agent(gradio_demo=True, vlm_base_url=vlm_url, retriever_model_id=args.retriever_model_id,
+                              context_token_budget=args.context_token_budget or None)
+        agent.scraper.search_tool_1.base_url = f"{web_url}/searchbyimage"
+        agent.scraper.search_tool_2 = Recorded_Search_Tool(os.path.join(fixtures_dir, 'search_tool_2.json'), web_url)
+        image_url = f"{web_url}/image.jpg"
+        agent.wait_for_retriever() # model loading is not part of the measured latencies (see benchmark_startup.py)
+
+        TRACER.last_traces = deque() # keep the trace of every question
+        def ask(i):
+            start = time.perf_counter()
+            agent.chat_with_agent(image_url, workload[i], session_id=f"question-{i}")
+            return 1000 * (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            question_latencies = list(executor.map(ask, range(len(workload))))
+        wall_time = time.perf_counter() - start
+
+        vlm_server.should_exit = True
+        web_server.shutdown()
+
+    stages = defaultdict(list)
+    for trace in TRACER.last_traces:
+        for name, duration in stage_durations(trace).items():
+            stages[name].append(duration)
+
+    results = {
+        'questions': len(workload),
+        'concurrency': args.concurrency,
+        'throughput_questions_per_second': len(workload) / wall_time,
+        'question_latency_ms': summarize(question_latencies),
+        'stage_latency_ms': {name: summarize(durations) for name, durations in sorted(stages.items())},
+        'counters': TRACER.stats()['counters'],
+    }
+
+    print(f"\n\t{len(workload)} questions, concurrency {args.concurrency}: {results['throughput_questions_per_second']:.2f} questions/s\n")
+    print(f"\t{'stage':<28}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'count':>8}")
+    for name, summary in [('question', results['question_latency_ms'])] + list(results['stage_latency_ms'].items()):
+        print(f"\t{name:<28}{summary['p50']:>10.1f}{summary['p90']:>10.1f}{summary['p99']:>10.1f}{summary['count']:>8}")
+    print(f"\n\tcounters: {json.dumps(results['counters'])}")
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        regressions = []
+        for name, summary, baseline_summary in [('question', results['question_latency_ms'], baseline['question_latency_ms'])] + \
+                [(name, summary, baseline['stage_latency_ms'][name]) for name, summary in results['stage_latency_ms'].items() if name in baseline['stage_latency_ms']]:
+            if summary['p50'] > (1 + args.max_regression) * baseline_summary['p50']:
+                regressions.append(f"{name}: p50 {baseline_summary['p50']:.1f} ms -> {summary['p50']:.1f} ms")
+        if len(regressions) > 0:
+            print("\n\tREGRESSIONS\n\t" + "\n\t".join(regressions))
+            sys.exit(1)
+        print(f"\n\tno p50 regression above {100 * args.max_regression:.0f}% compared to {args.baseline}")
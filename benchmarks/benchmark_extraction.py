@@ -0,0 +1,70 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from web_scraper import parse_webpage_contents, parse_webpage_contents_with_soup
+
+"""
+Compare the paragraph extraction engines over saved HTML pages (throughput and peak memory)
+ - soup   : full BeautifulSoup parse + soup.find_all(['p'])  (the original implementation)
+ - stream : event-based Paragraph_Extractor restricted to the article body
+
+Before the benchmark, the stream extractor is checked against benchmarks/fixtures/expected.json (small trimmed pages in
+the layout of Wikipedia articles): the number of extracted paragraphs, and text that must not be extracted (paragraphs
+before / after the mw-content-text container, citation markers, <style> / <script>, trivial paragraphs)
+
+`python benchmarks/benchmark_extraction.py` runs over the committed fixtures, save larger pages to benchmark on real ones,
+e.g. `curl -o pages/jewel.html https://en.wikipedia.org/wiki/Jewel_Changi_Airport` then `--fixtures_dir pages/`
+"""
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# regression check of parse_webpage_contents over the committed fixtures
+def check_fixtures(fixtures_dir=FIXTURES_DIR):
+    with open(os.path.join(fixtures_dir, 'expected.json'), 'r', encoding='utf-8') as file:
+        expected = json.load(file)
+    for file_name, page_expected in expected.items():
+        with open(os.path.join(fixtures_dir, file_name), 'rb') as file:
+            paragraphs = [content['content'] for content in parse_webpage_contents(file.read(), "title", "url")]
+        assert len(paragraphs) == page_expected['num_paragraphs'], f"{file_name}: {len(paragraphs)} paragraphs extracted, expected {page_expected['num_paragraphs']}"
+        for text in page_expected['excluded']:
+            assert not any(text in paragraph for paragraph in paragraphs), f"{file_name}: '{text}' should not be extracted"
+    print(f"\n\tregression check passed on {len(expected)} fixtures")
+
+def benchmark(parse_fn, pages, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for html_content in pages:
+            num_paragraphs = len(parse_fn(html_content, "title", "url"))
+    elapsed = time.perf_counter() - start
+
+    # peak memory of a single pass over all pages
+    tracemalloc.start()
+    for html_content in pages:
+        parse_fn(html_content, "title", "url")
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return len(pages) * repeats / elapsed, peak_memory, num_paragraphs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixtures_dir', type=str, default=FIXTURES_DIR)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    check_fixtures()
+
+    pages = []
+    for path in sorted(glob.glob(os.path.join(args.fixtures_dir, '*.html'))):
+        with open(path, 'rb') as file:
+            pages.append(file.read())
+    assert len(pages) > 0, f"No .html files found in {args.fixtures_dir}"
+    print(f"\n\t{len(pages)} pages, {sum(len(page) for page in pages) / 1e6:.1f} MB of html\n")
+
+    for name, parse_fn in [('soup', parse_webpage_contents_with_soup), ('stream', parse_webpage_contents)]:
+        pages_per_second, peak_memory, num_paragraphs = benchmark(parse_fn, pages, args.repeats)
+        print(f"\t{name:<8}: {pages_per_second:8.1f} pages/s   peak memory {peak_memory / 1e6:7.1f} MB   ({num_paragraphs} paragraphs in the last page)")
@@ -0,0 +1,56 @@
+import os
+import sys
+import time
+import argparse
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vlm_servers'))
+from prefix_cache import Prefix_KV_Cache, generate_with_prefix_cache
+
+"""
+Prompt-prefix KV caching with a small stand-in model on CPU
+ - the prompts mimic one SEARCH turn (same instruction header, different passages)
+ - every prompt is generated with and without the prefix cache, the outputs must be identical (greedy decoding)
+ - reports cache hits, reused / prefilled tokens and the latency of both paths
+
+`python benchmarks/benchmark_prefix_cache.py --model_id hf-internal-testing/tiny-random-LlamaForCausalLM`
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_id', type=str, default='hf-internal-testing/tiny-random-LlamaForCausalLM')
+    parser.add_argument('--num_prompts', type=int, default=10)
+    parser.add_argument('--max_new_tokens', type=int, default=20)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_id)
+    model = AutoModelForCausalLM.from_pretrained(args.model_id).eval()
+
+    header = "[Instruction] The following passage contains the response from an external search tool. " * 20
+    prompts = [f"{header}[Search Tool Response] Passage number {i} about the Rain Vortex. [Question] How tall is it?" for i in range(args.num_prompts)]
+    # the self-check of the same passage shares an even longer prefix
+    prompts += [f"{prompt} [Response] 40 metres." for prompt in prompts]
+
+    prefix_cache = Prefix_KV_Cache()
+    uncached_time, cached_time = 0.0, 0.0
+    for prompt in prompts:
+        input_ids = tokenizer(prompt, return_tensors='pt')['input_ids']
+
+        start = time.perf_counter()
+        with torch.no_grad():
+            reference = model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), max_new_tokens=args.max_new_tokens, do_sample=False)
+        reference = reference[:, input_ids.shape[1]:]
+        uncached_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        output = generate_with_prefix_cache(model, prefix_cache, 'image_hash', input_ids, max_new_tokens=args.max_new_tokens, do_sample=False)
+        cached_time += time.perf_counter() - start
+
+        assert torch.equal(reference, output), f"prefix-cached output differs from the reference for: {prompt[-60:]}"
+
+    print(f"\n\t{len(prompts)} prompts, outputs identical with and without the prefix cache")
+    print(f"\tcache stats     : {prefix_cache.stats()}")
+    print(f"\twithout cache   : {uncached_time:.3f} s")
+    print(f"\twith cache      : {cached_time:.3f} s")
@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from server_apis import My_VLM_APIs
+from tracing import TRACER
+
+"""
+Routing and failover of My_VLM_APIs over several replicas of benchmarks/stub_vlm_server.py (one process each)
+ - `--num_calls` /predict calls are issued by `--concurrency` threads, spread over `--num_replicas` stub servers
+ - after `--kill_after` seconds one replica is killed (in-flight calls on it fail over to the others), and restarted
+   `--restart_after` seconds later (re-admitted by the health checks)
+Reports the throughput, failed calls, the calls served by each replica and the number of failovers.
+
+`python benchmarks/benchmark_replicas.py --num_replicas 3 --kill_after 2 --restart_after 2`
+"""
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def start_stub_server(port):
+    process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'stub_vlm_server:app', '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+                               cwd=BENCHMARKS_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    while True:
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/ready", timeout=1.0).status_code == 200:
+                return process
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.05)
+
+def chaos(processes, ports, kill_after, restart_after):
+    time.sleep(kill_after)
+    processes[0].kill()
+    processes[0].wait()
+    print(f"\t{time.strftime('%X')} killed replica :{ports[0]}")
+    time.sleep(restart_after)
+    processes[0] = start_stub_server(ports[0])
+    print(f"\t{time.strftime('%X')} restarted replica :{ports[0]}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_replicas', type=int, default=3)
+    parser.add_argument('--num_calls', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--kill_after', type=float, default=None, help='kill the first replica after this many seconds')
+    parser.add_argument('--restart_after', type=float, default=2.0)
+    parser.add_argument('--health_check_interval', type=float, default=0.5)
+    args = parser.parse_args()
+
+    ports = [free_port() for _ in range(args.num_replicas)]
+    processes = [start_stub_server(port) for port in ports]
+    try:
+        vlm = My_VLM_APIs('phi3_vision', base_urls=[f"http://127.0.0.1:{port}" for port in ports], health_check_interval=args.health_check_interval)
+        image = Image.new('RGB', (384, 384), (90, 140, 200))
+        if args.kill_after is not None:
+            threading.Thread(target=chaos, args=(processes, ports, args.kill_after, args.restart_after), daemon=True).start()
+
+        def call(i):
+            try:
+                vlm.get_response(image, f"Question {i}: reply with '[SEARCH]' if you need more information.", max_new_tokens=8)
+                return True
+            except Exception:
+                return False
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            succeeded = list(executor.map(call, range(args.num_calls)))
+        wall_time = time.perf_counter() - start
+    finally:
+        for process in processes:
+            process.kill()
+
+    failovers = sum(value for key, value in TRACER.stats()['counters'].items() if key.startswith('vlm_failovers'))
+
+    print(f"\n\t{args.num_calls} calls over {args.num_replicas} replicas, concurrency {args.concurrency}: {args.num_calls / wall_time:.1f} calls/s")
+    print(f"\tfailed calls : {succeeded.count(False)}")
+    print(f"\tfailovers    : {failovers}")
+    for replica in vlm.pool.stats():
+        print(f"\t{replica['url']:<28} requests {replica['requests']:>6}  failures {replica['failures']:>4}  healthy {replica['healthy']}")
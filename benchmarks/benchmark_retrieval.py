@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from contriever_wrapper import Contriever_Model, Embedding_Cache
+from bm25_index import BM25_Index
+
+"""
+Two-stage retrieval (BM25 prefilter -> Contriever) against the dense-only path on saved corpora
+ - the dense-only top-K of every query is the reference, recall@K = overlap of the two-stage top-K with it
+ - each query starts from an empty embedding cache, so the latency includes embedding the (candidate) passages,
+   i.e. the cost of the first question on a new image
+ - without --queries, pseudo-queries are built from the first words of randomly sampled passages
+
+`python benchmarks/benchmark_retrieval.py --corpus parsed_search_results.json --num_candidates 10 20 50`
+"""
+
+def retrieve(contriever, query, corpus, K):
+    contriever.embedding_cache = Embedding_Cache(embedding_dim=contriever.model.config.hidden_size)
+    start = time.perf_counter()
+    top_K_contexts = contriever.get_topK_contexts(query, K=K, contexts=corpus)
+    return [context['content'] for context, score in top_K_contexts], time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus', type=str, nargs='+', default=['parsed_search_results.json'])
+    parser.add_argument('--queries', type=str, nargs='*', default=None)
+    parser.add_argument('--num_queries', type=int, default=20)
+    parser.add_argument('--K', type=int, default=10)
+    parser.add_argument('--num_candidates', type=int, nargs='+', default=[20, 50, 100])
+    parser.add_argument('--hybrid_weight', type=float, default=None)
+    args = parser.parse_args()
+
+    corpus = []
+    for path in args.corpus:
+        with open(path, 'r', encoding='utf-8') as file:
+            corpus.extend(json.load(file))
+    assert len(corpus) > 0, "The corpus is empty"
+
+    queries = args.queries
+    if not queries:
+        rng = random.Random(0)
+        queries = [" ".join(passage['content'].split()[:10]) for passage in rng.sample(corpus, min(args.num_queries, len(corpus)))]
+    print(f"\n\t{len(corpus)} passages, {len(queries)} queries, K={args.K}\n")
+
+    bm25_index = BM25_Index()
+    bm25_index.add_passages(corpus)
+    contriever = Contriever_Model(bm25_index=bm25_index)
+
+    # reference: every passage is embedded and scored
+    contriever.num_candidates, contriever.hybrid_weight = None, None
+    reference, dense_time = [], 0.0
+    for query in queries:
+        top_K, elapsed = retrieve(contriever, query, corpus, args.K)
+        reference.append(set(top_K))
+        dense_time += elapsed
+    print(f"\tdense only            : recall@{args.K} 1.000   {1000 * dense_time / len(queries):8.1f} ms/query")
+
+    contriever.hybrid_weight = args.hybrid_weight
+    for num_candidates in args.num_candidates:
+        contriever.num_candidates = num_candidates
+        recall, two_stage_time = 0.0, 0.0
+        for query, reference_top_K in zip(queries, reference):
+            top_K, elapsed = retrieve(contriever, query, corpus, args.K)
+            recall += len(reference_top_K.intersection(top_K)) / len(reference_top_K)
+            two_stage_time += elapsed
+        print(f"\tbm25 top-{num_candidates:<5} + dense : recall@{args.K} {recall / len(queries):.3f}   {1000 * two_stage_time / len(queries):8.1f} ms/query")
@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+import tempfile
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from web_scraper import Scraper
+
+"""
+Benchmark Scraper.extract_webpage_contents against a local HTTP server serving fixture pages
+ - serial   : one download at a time, parsed in the main process (the original behaviour)
+ - parallel : concurrent downloads + parsing in worker processes
+
+`python benchmarks/benchmark_scraper.py --num_pages 20 --latency_ms 200`
+"""
+
+def write_fixture_pages(directory, num_pages, paragraphs_per_page):
+    paragraph = "The Rain Vortex is the world's tallest indoor waterfall, surrounded by a terraced forest setting. " * 3
+    for page in range(num_pages):
+        body = "".join(f"<p>{paragraph} ({page}-{i})</p>" for i in range(paragraphs_per_page))
+        with open(os.path.join(directory, f"page_{page}.html"), 'w', encoding='utf-8') as file:
+            file.write(f"<html><body><div id='mw-content-text'>{body}</div></body></html>")
+
+def start_fixture_server(directory, latency_ms):
+    class Handler(SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+        def do_GET(self):
+            time.sleep(latency_ms / 1000) # simulated network latency
+            super().do_GET()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run(scraper, search_results, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        scraper.extract_webpage_contents(search_results)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_pages', type=int, default=20)
+    parser.add_argument('--paragraphs_per_page', type=int, default=100)
+    parser.add_argument('--latency_ms', type=float, default=200)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_fixture_pages(directory, args.num_pages, args.paragraphs_per_page)
+        server = start_fixture_server(directory, args.latency_ms)
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        search_results = {f"page_{page}": {"Title": f"Fixture page {page}", "URL": f"{base_url}/page_{page}.html"} for page in range(args.num_pages)}
+
+        serial = run(Scraper(max_fetch_workers=1, max_parse_workers=0, cache_dir=None), search_results, args.repeats)
+        parallel = run(Scraper(cache_dir=None), search_results, args.repeats)
+        server.shutdown()
+
+    print(f"\n\t{args.num_pages} pages, {args.latency_ms} ms latency")
+    print(f"\tserial   : {serial:.3f} s")
+    print(f"\tparallel : {parallel:.3f} s  ({serial / parallel:.1f}x)")
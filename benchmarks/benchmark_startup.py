@@ -0,0 +1,86 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+
+import requests
+
+"""
+Cold-start time of the agent (what chat.py / gradio_demo.py wait for) and of the VLM servers
+ - agent  : a fresh interpreter imports search_agent and creates vlm_rag_agent - reports the import time, the time until
+            the agent is created (chat prompt) and the time until the retriever is loaded in the background
+            (with --foreground_init the retriever is loaded in the constructor, i.e. the old behaviour)
+ - server : uvicorn is started for each --servers module - reports the time until /health answers (accepting requests)
+            and until /ready returns 200 (model loaded)
+
+`python benchmarks/benchmark_startup.py --servers Phi3_Vision_Server`
+"""
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+AGENT_STARTUP = """
+import time, json
+start = time.perf_counter()
+from search_agent import vlm_rag_agent
+imported = time.perf_counter()
+agent = vlm_rag_agent(gradio_demo=True, background_init={background_init})
+created = time.perf_counter()
+agent.wait_for_retriever()
+ready = time.perf_counter()
+print(json.dumps({{'import_s': imported - start, 'agent_created_s': created - start, 'retriever_ready_s': ready - start}}))
+"""
+
+def agent_startup(background_init):
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', AGENT_STARTUP.format(background_init=background_init)], cwd=REPO_DIR,
+                            capture_output=True, text=True, check=True).stdout
+    timings = json.loads(output.strip().splitlines()[-1])
+    timings['interpreter_total_s'] = time.perf_counter() - start
+    return timings
+
+def server_startup(module, timeout):
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    base_url = f"http://127.0.0.1:{port}"
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-m', 'uvicorn', f'{module}:app', '--host', '127.0.0.1', '--port', str(port)],
+                               cwd=os.path.join(REPO_DIR, 'vlm_servers'), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    timings = {'health_s': None, 'ready_s': None}
+    try:
+        while time.perf_counter() - start < timeout and process.poll() is None:
+            try:
+                if timings['health_s'] is None and requests.get(f"{base_url}/health", timeout=1.0).ok:
+                    timings['health_s'] = time.perf_counter() - start
+                if timings['health_s'] is not None and requests.get(f"{base_url}/ready", timeout=1.0).status_code == 200:
+                    timings['ready_s'] = time.perf_counter() - start
+                    break
+            except requests.exceptions.ConnectionError:
+                pass
+            time.sleep(0.1)
+    finally:
+        process.terminate()
+        process.wait()
+    return timings
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--foreground_init', action='store_true')
+    parser.add_argument('--servers', type=str, nargs='*', default=[])
+    parser.add_argument('--server_timeout', type=float, default=600)
+    args = parser.parse_args()
+
+    runs = [agent_startup(background_init=not args.foreground_init) for _ in range(args.repeats)]
+    print(f"\n\tagent ({'foreground' if args.foreground_init else 'background'} retriever init), best of {args.repeats}")
+    for key in runs[0]:
+        print(f"\t{key:<22}: {min(run[key] for run in runs):8.2f} s")
+
+    for module in args.servers:
+        timings = server_startup(module, args.server_timeout)
+        print(f"\n\t{module}")
+        for key, value in timings.items():
+            print(f"\t{key:<22}: " + (f"{value:8.2f} s" if value is not None else "     n/a"))
@@ -0,0 +1,138 @@
+import os
+import re
+import time
+import base64
+import hashlib
+import threading
+
+from typing import Optional, List, Dict
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+"""
+Stub of the Phi3_Vision_Server API (/register_image, /predict, /predict_stream, /classify, /health, /ready) for benchmarks without a GPU
+ - latency of a call = STUB_VLM_PREFILL_MS + STUB_VLM_MS_PER_TOKEN * number of generated words, at most
+   STUB_VLM_CONCURRENCY calls are "on the GPU" at once (the others wait)
+ - scripted responses, picked from the prompt type of the agent (the same prompt always gets the same response)
+     tool_use_prompt                : '[SEARCH]' (direct answer for a STUB_VLM_DIRECT_ANSWER_RATE fraction of the questions)
+     get_contriever_search_keywords : a few keywords taken from the question
+     answer_with_context_prompt     : '[SKIP PASSAGE]' for a STUB_VLM_SKIP_RATE fraction of the passages, else an answer
+                                      (citing the first [n] marker of a pack of passages)
+     /classify (self_check)         : the first label for a STUB_VLM_OK_RATE fraction of the prompts, else the second one
+
+`cd benchmarks && uvicorn stub_vlm_server:app --host 127.0.0.1 --port 8001` (or started in-process by benchmark_end_to_end.py)
+"""
+CONFIG = {
+    'prefill_ms': float(os.environ.get("STUB_VLM_PREFILL_MS", 150)),
+    'ms_per_token': float(os.environ.get("STUB_VLM_MS_PER_TOKEN", 20)),
+    'concurrency': int(os.environ.get("STUB_VLM_CONCURRENCY", 4)),
+    'direct_answer_rate': float(os.environ.get("STUB_VLM_DIRECT_ANSWER_RATE", 0.0)),
+    'skip_rate': float(os.environ.get("STUB_VLM_SKIP_RATE", 0.5)),
+    'ok_rate': float(os.environ.get("STUB_VLM_OK_RATE", 0.7)),
+}
+
+app = FastAPI()
+gpu_slots = None
+gpu_slots_lock = threading.Lock()
+registered_images = set()
+
+class ImageTextRequest(BaseModel):
+    str_image: str = 'No Image Provided'
+    image_handle: Optional[str] = None
+    user_query: str
+    max_new_tokens: int = 200
+    stop: Optional[List[str]] = None
+    do_sample: bool = False
+    temperature: float = 1.0
+    top_p: float = 1.0
+
+class TextResponse(BaseModel):
+    vlm_response: str
+
+class ImageRequest(BaseModel):
+    str_image: str
+
+class ImageHandleResponse(BaseModel):
+    image_handle: str
+
+class ClassifyRequest(BaseModel):
+    str_image: str = 'No Image Provided'
+    image_handle: Optional[str] = None
+    user_query: str
+    labels: List[str]
+
+class ClassifyResponse(BaseModel):
+    label: str
+    scores: Dict[str, float]
+
+# deterministic number in [0, 1) for a piece of text
+def text_fraction(text):
+    return int(hashlib.sha1(text.encode('utf-8')).hexdigest()[:8], 16) / 2 ** 32
+
+def scripted_response(prompt):
+    if "reply with '[SEARCH]'" in prompt:
+        return "The image shows a large indoor waterfall." if text_fraction(prompt) < CONFIG['direct_answer_rate'] else "[SEARCH]"
+    if "NO MORE THAN FIVE keywords" in prompt:
+        question = prompt.split("[Question]")[-1].split("[Instruction]")[0]
+        return ", ".join(word.strip(".,?") for word in question.split()[:5])
+    if "[Search Tool Response]" in prompt:
+        if text_fraction(prompt) < CONFIG['skip_rate']:
+            return "[SKIP PASSAGE]"
+        # packed passages (see context_packer.py): cite the first passage marker
+        citation = re.search(r"\[\d+\]", prompt.split("[Search Tool Response]")[-1])
+        return "According to the passage, the Rain Vortex is the tallest indoor waterfall in the world." + (f" {citation.group(0)}" if citation else "")
+    return "I am a stub model."
+
+# hold one of the "GPU" slots for the simulated prefill + decode time
+def simulate_generation(num_generated_tokens):
+    global gpu_slots
+    with gpu_slots_lock:
+        if gpu_slots is None:
+            gpu_slots = threading.Semaphore(CONFIG['concurrency'])
+    with gpu_slots:
+        time.sleep((CONFIG['prefill_ms'] + CONFIG['ms_per_token'] * num_generated_tokens) / 1000)
+
+def check_image(request):
+    if request.image_handle is not None and request.image_handle not in registered_images:
+        raise HTTPException(status_code=404, detail=f"Unknown image handle {request.image_handle}")
+
+@app.get('/health')
+def health():
+    return {'status': "ok"}
+
+@app.get('/ready')
+def ready():
+    return {'status': "ready"}
+
+@app.post('/register_image', response_model=ImageHandleResponse)
+def register_image(request: ImageRequest):
+    handle = hashlib.sha256(base64.b64decode(request.str_image)).hexdigest()
+    registered_images.add(handle)
+    return ImageHandleResponse(image_handle=handle)
+
+@app.post('/predict', response_model=TextResponse)
+def predict(request: ImageTextRequest):
+    check_image(request)
+    response = scripted_response(request.user_query)
+    simulate_generation(min(len(response.split()), request.max_new_tokens))
+    return TextResponse(vlm_response=response)
+
+@app.post('/predict_stream')
+def predict_stream(request: ImageTextRequest):
+    check_image(request)
+    words = scripted_response(request.user_query).split()[:request.max_new_tokens]
+
+    def stream():
+        time.sleep(CONFIG['prefill_ms'] / 1000)
+        for i, word in enumerate(words):
+            time.sleep(CONFIG['ms_per_token'] / 1000)
+            yield word if i == 0 else f" {word}"
+    return StreamingResponse(stream(), media_type="text/plain")
+
+@app.post('/classify', response_model=ClassifyResponse)
+def classify(request: ClassifyRequest):
+    check_image(request)
+    simulate_generation(0)
+    label = request.labels[0] if text_fraction(request.user_query) < CONFIG['ok_rate'] else request.labels[-1]
+    return ClassifyResponse(label=label, scores={candidate: (0.0 if candidate == label else -5.0) for candidate in request.labels})
@@ -0,0 +1,87 @@
+import re
+import math
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+import numpy as np
+
+"""
+                                BM25 Lexical Index over the Scraped Passages
+
+The passages are tokenized as the Scraper produces them ({passage_key: term frequencies}), so scoring a candidate set
+only looks up term frequencies. Contriever_Model uses it as a cheap first stage: only the `num_candidates` passages with
+the best BM25 score are densely scored (optionally the BM25 and Contriever scores are fused into the final score).
+ - passages are keyed by the sha1 hash of their text (same key as the Contriever Embedding_Cache), so a passage scraped
+   for several images is tokenized once
+ - the index is bounded: at most `max_passages` passages are kept, the least recently used ones are evicted
+ - collection statistics (idf, average length) are computed over the candidate set being ranked (the corpus of the
+   current question), passages scraped for earlier images do not skew the scores
+"""
+TOKEN_PATTERN = re.compile(r"\w+")
+STOPWORDS = frozenset("""a an and are as at be by for from has have in is it its of on or that the this to was were which
+                         with what who whom when where why how does did do""".split())
+
+class BM25_Index():
+    def __init__(self, k1=1.2, b=0.75, max_passages=50000):
+        self.k1 = k1
+        self.b = b
+        self.max_passages = max_passages
+        self.passages = OrderedDict() # {passage_key: (term frequencies, number of tokens)} in LRU order
+        # passages are added by the scraper threads while sessions are searching
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def tokenize(text):
+        return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+    # (term frequencies, number of tokens) of a passage
+    @classmethod
+    def term_statistics(cls, text):
+        tokens = cls.tokenize(text)
+        return Counter(tokens), len(tokens)
+
+    @staticmethod
+    def passage_key(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    # passages in the format of Scraper.extract_webpage_contents, already indexed passages are only marked as recently used
+    def add_passages(self, passages):
+        with self.lock:
+            for passage in passages:
+                key = self.passage_key(passage['content'])
+                if key in self.passages:
+                    self.passages.move_to_end(key)
+                    continue
+                self.passages[key] = self.term_statistics(passage['content'])
+            while len(self.passages) > self.max_passages:
+                self.passages.popitem(last=False)
+
+    # BM25 score of every passage in `contexts` for the query (numpy array aligned with contexts)
+    # idf and average length are taken over `contexts`
+    def score(self, query, contexts):
+        keys = [self.passage_key(passage['content']) for passage in contexts]
+        # contexts that did not come through the scraper (e.g. read from parsed_search_results.json) or were evicted are indexed now
+        self.add_passages(contexts)
+
+        scores = np.zeros(len(contexts), dtype=np.float32)
+        with self.lock:
+            indexed = [self.passages.get(key) for key in keys]
+        # a candidate set larger than the index evicts some of its own passages, they are tokenized again here
+        indexed = [entry if entry is not None else self.term_statistics(passage['content']) for entry, passage in zip(indexed, contexts)]
+        lengths = np.array([length for _, length in indexed], dtype=np.float32)
+        if len(contexts) == 0 or lengths.sum() == 0:
+            return scores
+        length_norm = self.k1 * (1 - self.b + self.b * lengths / lengths.mean())
+
+        for term in set(self.tokenize(query)):
+            term_frequencies = np.array([term_counts.get(term, 0) for term_counts, _ in indexed], dtype=np.float32)
+            document_frequency = np.count_nonzero(term_frequencies)
+            if document_frequency == 0:
+                continue
+            idf = math.log(1 + (len(contexts) - document_frequency + 0.5) / (document_frequency + 0.5))
+            scores += idf * term_frequencies * (self.k1 + 1) / (term_frequencies + length_norm)
+        return scores
+
+    def __len__(self):
+        with self.lock:
+            return len(self.passages)
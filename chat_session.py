@@ -0,0 +1,54 @@
+import time
+import threading
+
+"""
+                                Per-session Chat State
+
+Everything that belongs to one chat (image, scraped corpus, output buffer) lives in a Chat_Session object instead of
+on the agent, so one agent (one process) can serve many simultaneous chats without them overwriting each other.
+Embeddings are not stored per session - they live in the Contriever embedding cache (keyed by passage content hash),
+so sessions on the same image / Wikipedia page share them.
+"""
+class Chat_Session():
+    def __init__(self, session_id):
+        self.session_id = session_id
+
+        # placeholder for image
+        self.image = None
+        self.image_hash = None
+        # used to check if new (image & search results) must be loaded or current (image & search results) is enough!
+        self.currently_active_image_url = ""
+        self.is_search_results_available_for_currently_active_image_url = False
+        # text paragraphs scraped for the current image (passed straight from the Scraper to the Contriever model)
+        self.corpus = []
+
+        # output formatted for gradio_demo.py
+        self.gradio_string = ""
+
+        # a session answers one question at a time
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+
+"""
+Sessions idle for more than `idle_timeout` seconds are evicted (checked whenever a session is requested)
+"""
+class Session_Store():
+    def __init__(self, idle_timeout=30 * 60):
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get_session(self, session_id):
+        now = time.monotonic()
+        with self.lock:
+            for idle_session_id in [key for key, session in self.sessions.items() if now - session.last_used > self.idle_timeout and not session.lock.locked()]:
+                del self.sessions[idle_session_id]
+            if session_id not in self.sessions:
+                self.sessions[session_id] = Chat_Session(session_id)
+            session = self.sessions[session_id]
+            session.last_used = now
+            return session
+
+    def __len__(self):
+        return len(self.sessions)
@@ -0,0 +1,50 @@
+import re
+
+"""
+                                Token-Budget Context Packing
+
+Instead of one answer (+ self-check) VLM call per retrieved passage, the ranked passages are grouped into packs of at
+most `token_budget` tokens, and each pack is answered in a single call.
+ - passages are packed greedily in relevance order, so the first pack holds the most relevant passages (an early stop
+   of the SEARCH turn still drops the least relevant ones). A passage larger than the budget gets a pack of its own
+ - every passage is prefixed with a citation marker [n] (n = its rank among the retrieved passages), the VLM is asked
+   to cite the markers of the passages it used, which maps the answer back to their URLs
+ - the number of tokens is estimated from the number of characters (the tokenizer lives in the VLM server)
+"""
+class Context_Packer():
+    def __init__(self, token_budget=1536, chars_per_token=4):
+        self.token_budget = token_budget
+        self.chars_per_token = chars_per_token
+
+    def num_tokens(self, text):
+        return len(text) // self.chars_per_token + 1
+
+    # contexts = retrieved passages ({'Title', 'URL', 'content'}) in relevance order
+    # returns the packs, each a list of (rank, context) - rank is the index of the passage in contexts
+    def pack(self, contexts):
+        packs, current_pack, current_tokens = [], [], 0
+        for rank, context in enumerate(contexts):
+            num_tokens = self.num_tokens(self.format_passage(rank, context))
+            if len(current_pack) > 0 and current_tokens + num_tokens > self.token_budget:
+                packs.append(current_pack)
+                current_pack, current_tokens = [], 0
+            current_pack.append((rank, context))
+            current_tokens += num_tokens
+        if len(current_pack) > 0:
+            packs.append(current_pack)
+        return packs
+
+    @staticmethod
+    def format_passage(rank, context):
+        return f"[{rank + 1}] {context['content']}"
+
+    # the text of the pack that is sent to the VLM
+    def format(self, pack):
+        return "\n".join(self.format_passage(rank, context) for rank, context in pack)
+
+    # the (rank, context) of the pack cited by [n] markers in the answer - the whole pack if the answer cites none of them
+    @staticmethod
+    def cited_passages(answer, pack):
+        cited_ranks = {int(number) - 1 for number in re.findall(r"\[(\d+)\]", answer)}
+        cited = [(rank, context) for rank, context in pack if rank in cited_ranks]
+        return cited if len(cited) > 0 else pack
@@ -1,48 +1,323 @@
+import os
+import time
 import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
 from nltk.tokenize import sent_tokenize
 import torch
 from transformers import AutoTokenizer, AutoModel
 
+from tracing import TRACER
+
+
+"""
+                                Passage Embedding Cache
+
+Sentence embeddings of a passage are stored under the sha1 hash of the passage text, so
+ - follow-up questions on the same image only need to embed the query
+ - passages shared between images (same Wikipedia page) are encoded only once
+
+In-memory tier : LRU dict of at most `max_passages` passages
+On-disk tier   : (optional) float16 matrix memory-mapped from `cache_dir/embeddings.npy` + a json index {hash: [row, num_rows]}
+The embeddings are only valid for the model that produced them: the model id and embedding size are kept in the json index,
+and an on-disk tier written by another model is dropped (rebuilt empty), like the vectors of the Passage_Store.
+"""
+class Embedding_Cache():
+    def __init__(self, max_passages=5000, cache_dir=None, disk_capacity=200000, embedding_dim=768, model_id='facebook/contriever'):
+        self.max_passages = max_passages
+        self.memory = OrderedDict()
+        # the cache is shared by all chat sessions (threads)
+        self.lock = threading.RLock()
+
+        self.cache_dir = cache_dir
+        self.model_id = model_id
+        self.embedding_dim = embedding_dim
+        self.disk_matrix = None
+        self.disk_index = {}
+        self.disk_rows_used = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            matrix_path = os.path.join(cache_dir, 'embeddings.npy')
+            index_path = os.path.join(cache_dir, 'index.json')
+            index = {}
+            if os.path.exists(matrix_path) and os.path.exists(index_path):
+                with open(index_path, 'r', encoding='utf-8') as file:
+                    index = json.load(file)
+                stored_model = {'model_id': index.get('model_id'), 'embedding_dim': index.get('embedding_dim')}
+                if stored_model != self.model_metadata():
+                    logging.warning(f"Embedding cache {cache_dir} was written by {stored_model}, rebuilding it for {self.model_metadata()}")
+                    index = {}
+            if len(index) > 0:
+                self.disk_matrix = np.load(matrix_path, mmap_mode='r+')
+                # the matrix itself has to match as well (e.g. an index.json copied from another cache)
+                if self.disk_matrix.shape[1] != embedding_dim:
+                    logging.warning(f"Embedding cache {cache_dir} holds {self.disk_matrix.shape[1]}-d embeddings, rebuilding it for {embedding_dim}-d")
+                    self.disk_matrix, index = None, {}
+            if len(index) > 0:
+                self.disk_index = index['passages']
+                self.disk_rows_used = index['rows_used']
+            else:
+                self.disk_matrix = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float16, shape=(disk_capacity, embedding_dim))
+
+    def model_metadata(self):
+        return {'model_id': self.model_id, 'embedding_dim': self.embedding_dim}
+
+    @staticmethod
+    def passage_hash(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+            if key in self.disk_index:
+                row, num_rows = self.disk_index[key]
+                embeddings = torch.from_numpy(np.array(self.disk_matrix[row:row + num_rows], dtype=np.float32))
+                self._put_in_memory(key, embeddings)
+                return embeddings
+            return None
+
+    def put(self, key, embeddings):
+        embeddings = embeddings.detach().float()
+        with self.lock:
+            self._put_in_memory(key, embeddings)
+            # spill to disk while there is room left in the memory-mapped matrix
+            if self.disk_matrix is not None and key not in self.disk_index and self.disk_rows_used + len(embeddings) <= len(self.disk_matrix):
+                self.disk_matrix[self.disk_rows_used:self.disk_rows_used + len(embeddings)] = embeddings.cpu().numpy().astype(np.float16)
+                self.disk_index[key] = [self.disk_rows_used, len(embeddings)]
+                self.disk_rows_used += len(embeddings)
+
+    def _put_in_memory(self, key, embeddings):
+        self.memory[key] = embeddings
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_passages:
+            self.memory.popitem(last=False)
+
+    # write the on-disk index so that the cache survives a restart
+    def flush(self):
+        if self.disk_matrix is None:
+            return
+        with self.lock:
+            self.disk_matrix.flush()
+            with open(os.path.join(self.cache_dir, 'index.json'), 'w', encoding='utf-8') as file:
+                json.dump({**self.model_metadata(), 'rows_used': self.disk_rows_used, 'passages': self.disk_index}, file)
+
+
+"""
+Contriever can run either on a GPU or on CPU-only nodes (keeps the GPU free for the VLM)
+ - device=None picks "cuda:0" when available, else "cpu"
+ - on CPU the BERT linear layers are dynamically quantized to int8 (quantize=None -> quantize only on CPU)
+ - the intra-op threads used by torch on CPU are not set here: torch.set_num_threads applies to the whole process (the
+   VLM client, any other torch user), so it is set once at startup (see retriever_num_threads of vlm_rag_agent)
+
+Two-stage retrieval (bm25_index given, see bm25_index.py)
+ - corpora larger than `num_candidates` passages are narrowed to the `num_candidates` best BM25 passages before dense scoring
+ - hybrid_weight=None ranks the candidates by the Contriever score only, otherwise by
+   hybrid_weight * bm25 + (1 - hybrid_weight) * contriever (both min-max normalized over the candidates)
+"""
 class Contriever_Model():
-    def __init__(self,):
-        self.device = torch.device("cuda:0")
-        self.tokenizer = AutoTokenizer.from_pretrained('facebook/contriever')
-        self.model = AutoModel.from_pretrained('facebook/contriever').to(self.device)
+    def __init__(self, device=None, batch_size=64, embedding_cache=None, quantize=None, passage_store=None, bm25_index=None, num_candidates=100, hybrid_weight=None, model_id='facebook/contriever'):
+        if device is None:
+            device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        if quantize is None:
+            quantize = self.device.type == "cpu"
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_id)
+        self.model = AutoModel.from_pretrained(model_id)
+        if quantize:
+            assert self.device.type == "cpu", "dynamic int8 quantization is only supported on CPU"
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = self.model.to(self.device)
+        self.model.eval()
+        # maximum number of sentences encoded in a single forward pass
+        self.batch_size = batch_size
+        # passage embeddings are reused across questions (and images) through this cache
+        self.embedding_cache = embedding_cache if embedding_cache is not None else Embedding_Cache(embedding_dim=self.model.config.hidden_size, model_id=model_id)
+        # parsed search results are only re-read from disk when the file changes
+        self.contexts = None
+        self.contexts_mtime = None
+        # (optional) persistent knowledge base - one vector per passage, computed once and reused by every image / restart
+        self.passage_store = passage_store
+        # (optional) lexical prefilter / score fusion
+        self.bm25_index = bm25_index
+        self.num_candidates = num_candidates
+        self.hybrid_weight = hybrid_weight
+        # running totals used to report the embedding throughput
+        self.num_encoded_sentences = 0
+        self.encoding_time = 0.0
+
+    # run the first (slow) calls of the tokenizer, model and sentence splitter before the first query arrives
+    # then encode one full mini-batch to log the embedding throughput of this device
+    def warm_up(self):
+        sent_tokenize("Warm up the sentence splitter. And the model.")
+        self._encode_sentences(["warm up"]) # not traced
+        self.num_encoded_sentences, self.encoding_time = 0, 0.0
+        self._encode_sentences([f"Sentence number {i} used to measure the embedding throughput of the retriever." for i in range(self.batch_size)])
+        logging.info(f"Contriever embedding throughput: {self.embedding_throughput()}")
+        self.num_encoded_sentences, self.encoding_time = 0, 0.0
 
     def contriever_mean_pooling(self, token_embeddings, mask):
         token_embeddings = token_embeddings.masked_fill(~mask[..., None].bool(), 0.)
         sentence_embeddings = token_embeddings.sum(dim=1) / mask.sum(dim=1)[..., None]
         return sentence_embeddings
 
-    def get_contriever_embeddings(self, sentences):
-        contriver_inputs = self.tokenizer(sentences, padding=True, truncation=True, return_tensors='pt').to(self.device)
-        contriver_outputs = self.model(**contriver_inputs)
-        embeddings = self.contriever_mean_pooling(contriver_outputs[0], contriver_inputs['attention_mask']).detach()
+    # encode any number of sentences in mini-batches of at most self.batch_size sentences
+    # sentences are sorted by token length so that each mini-batch carries as little padding as possible
+    # (encoded sentences counter / contriever_encode span seconds in TRACER.stats() = embedding throughput while serving)
+    def encode_sentences(self, sentences):
+        TRACER.increment('contriever_encoded_sentences', len(sentences))
+        with TRACER.span('contriever_encode', num_sentences=len(sentences)):
+            return self._encode_sentences(sentences)
+
+    def _encode_sentences(self, sentences):
+        start_time = time.perf_counter()
+        tokenized = self.tokenizer(sentences, truncation=True)
+        order = sorted(range(len(sentences)), key=lambda idx: len(tokenized['input_ids'][idx]))
+
+        embeddings = torch.empty((len(sentences), self.model.config.hidden_size), device=self.device)
+        with torch.inference_mode():
+            for start in range(0, len(order), self.batch_size):
+                batch_ids = order[start:start + self.batch_size]
+                batch = self.tokenizer.pad(
+                    {key: [tokenized[key][idx] for idx in batch_ids] for key in tokenized.keys()},
+                    return_tensors='pt',
+                ).to(self.device)
+                contriver_outputs = self.model(**batch)
+                embeddings[batch_ids] = self.contriever_mean_pooling(contriver_outputs[0], batch['attention_mask']).to(embeddings.dtype)
+
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        self.encoding_time += time.perf_counter() - start_time
+        self.num_encoded_sentences += len(sentences)
         return embeddings
 
+    # sentences encoded per second since the model was loaded
+    def embedding_throughput(self):
+        return {
+            'device': str(self.device),
+            'num_threads': torch.get_num_threads(),
+            'encoded_sentences': self.num_encoded_sentences,
+            'encoding_time_s': round(self.encoding_time, 3),
+            'sentences_per_second': round(self.num_encoded_sentences / self.encoding_time, 1) if self.encoding_time > 0 else 0.0,
+        }
+
     def load_json_file(self,):
-        with open('parsed_search_results.json', 'r', encoding='utf-8') as file:
-            return json.load(file)
+        mtime = os.path.getmtime('parsed_search_results.json')
+        if self.contexts is None or mtime != self.contexts_mtime:
+            with open('parsed_search_results.json', 'r', encoding='utf-8') as file:
+                self.contexts = json.load(file)
+            self.contexts_mtime = mtime
+        return self.contexts
+
+    # sentence embeddings for every paragraph, only the paragraphs missing from the cache are encoded
+    def get_passage_embeddings(self, contexts):
+        keys = [Embedding_Cache.passage_hash(paragraph['content']) for paragraph in contexts]
+        passage_embeddings = [self.embedding_cache.get(key) for key in keys]
+        num_cached = sum(embeddings is not None for embeddings in passage_embeddings)
+        TRACER.increment('embedding_cache', num_cached, result="hit")
+        TRACER.increment('embedding_cache', len(keys) - num_cached, result="miss")
+
+        # flatten the sentences of every uncached paragraph into one list (duplicate passages are encoded once)
+        missing, sentences = {}, []
+        with TRACER.span('sent_tokenize'):
+            for key, paragraph, embeddings in zip(keys, contexts, passage_embeddings):
+                if embeddings is None and key not in missing:
+                    paragraph_sentences = sent_tokenize(paragraph['content'])
+                    missing[key] = (len(sentences), len(paragraph_sentences))
+                    sentences.extend(paragraph_sentences)
+
+        # a paragraph without any sentence (e.g. empty content) gets no sentence embeddings (scored 0)
+        encoded = {}
+        if len(missing) > 0:
+            if len(sentences) > 0:
+                sentence_embeddings = self.encode_sentences(sentences)
+            else:
+                sentence_embeddings = torch.empty((0, self.model.config.hidden_size), device=self.device)
+            for key, (start, count) in missing.items():
+                encoded[key] = sentence_embeddings[start:start + count]
+                self.embedding_cache.put(key, encoded[key])
+            self.embedding_cache.flush()
+
+        return [embeddings if embeddings is not None else encoded[key] for key, embeddings in zip(keys, passage_embeddings)]
+
+    # passage vectors (sum of the sentence embeddings) from the passage store, missing vectors are computed and stored
+    def get_passage_vectors(self, contexts):
+        passage_ids = [paragraph['passage_id'] for paragraph in contexts]
+        vectors, has_vector = self.passage_store.get_vectors(passage_ids)
+        missing = [i for i in range(len(passage_ids)) if not has_vector[i]]
+        if len(missing) > 0:
+            passage_embeddings = self.get_passage_embeddings([contexts[i] for i in missing])
+            new_vectors = torch.stack([embeddings.to(self.device).sum(dim=0) for embeddings in passage_embeddings]).cpu().numpy()
+            vectors[missing] = new_vectors
+            self.passage_store.set_vectors([passage_ids[i] for i in missing], new_vectors)
+        return torch.from_numpy(vectors).to(self.device)
 
     def compute_relevance_scores(self, query, contexts):
 
-        query_embedding = self.get_contriever_embeddings([query])[0]
-        relevance_scores = []
+        # passages from the passage store: one vector per passage, sum(query . sentence) == query . sum(sentences)
+        if self.passage_store is not None and all('passage_id' in paragraph for paragraph in contexts):
+            query_embedding = self.encode_sentences([query])[0]
+            return self.get_passage_vectors(contexts) @ query_embedding
+
+        # stack the (cached) sentence embeddings of every paragraph and remember which paragraph each sentence came from
+        passage_embeddings = self.get_passage_embeddings(contexts)
+        paragraph_ids = [paragraph_id for paragraph_id, embeddings in enumerate(passage_embeddings) for _ in range(len(embeddings))]
 
-        for paragraph in contexts:
-            # Tokenize the paragraph
-            sentences = sent_tokenize(paragraph['content'])
-            sentence_embeddings = self.get_contriever_embeddings(sentences)
-            # Compute similarity scores and aggregate them
-            scores = [torch.dot(query_embedding, sentence_embedding) for sentence_embedding in sentence_embeddings]
-            relevance_scores.append(sum(scores).item())
+        relevance_scores = torch.zeros(len(contexts), device=self.device)
+        if len(paragraph_ids) == 0:
+            return relevance_scores
+
+        query_embedding = self.encode_sentences([query])[0]
+        sentence_embeddings = torch.cat(passage_embeddings).to(self.device)
+
+        # similarity of every sentence in a single matmul, then summed per paragraph (segment-sum)
+        sentence_scores = sentence_embeddings @ query_embedding
+        paragraph_ids = torch.tensor(paragraph_ids, device=self.device)
+        relevance_scores.index_add_(0, paragraph_ids, sentence_scores)
         return relevance_scores
 
     # Return the top-K most informative contexts relevant to the query
-    def get_topK_contexts(self, query, K=7):
-        contexts = self.load_json_file()
+    # contexts = list of paragraphs from Scraper.extract_webpage_contents (read from parsed_search_results.json if not given)
+    def get_topK_contexts(self, query, K=7, contexts=None):
+        if contexts is None:
+            contexts = self.load_json_file()
+        if len(contexts) == 0:
+            return []
+
+        # first stage: keep the best BM25 passages only (in corpus order), the others are never embedded
+        lexical_scores = None
+        prefilter = self.num_candidates is not None and len(contexts) > self.num_candidates
+        if self.bm25_index is not None and (prefilter or self.hybrid_weight is not None):
+            with TRACER.span('bm25_prefilter', num_passages=len(contexts)):
+                lexical_scores = torch.from_numpy(self.bm25_index.score(query, contexts))
+            if prefilter:
+                candidate_ids = torch.topk(lexical_scores, k=self.num_candidates).indices.sort().values
+                contexts = [contexts[idx] for idx in candidate_ids.tolist()]
+                lexical_scores = lexical_scores[candidate_ids]
+
+        # second stage: dense scoring of the candidates (optionally fused with the lexical scores)
         relevance_scores = self.compute_relevance_scores(query, contexts)
-        # Combine paragraphs and their scores, sort by scores
-        paragraphs_with_scores = list(zip(contexts, relevance_scores))
-        paragraphs_with_scores.sort(key=lambda x: x[1], reverse=True)
-        return paragraphs_with_scores[:K]
\ No newline at end of file
+        if lexical_scores is not None and self.hybrid_weight is not None:
+            relevance_scores = self.hybrid_weight * min_max_normalize(lexical_scores.to(relevance_scores.device)) + (1 - self.hybrid_weight) * min_max_normalize(relevance_scores)
+
+        # select the K highest scoring paragraphs (sorted by scores)
+        top_scores, top_ids = torch.topk(relevance_scores, k=min(K, len(contexts)))
+        return [(contexts[idx], score) for idx, score in zip(top_ids.tolist(), top_scores.tolist())]
+
+    # search the whole passage store (approximate, IVF index) or only the passages of the given page urls (exact)
+    def search_knowledge_base(self, query, K=7, urls=None):
+        assert self.passage_store is not None, "Contriever_Model was created without a passage_store"
+        query_embedding = self.encode_sentences([query])[0].cpu().numpy()
+        return self.passage_store.search(query_embedding, K=K, urls=urls)
+
+
+def min_max_normalize(scores):
+    score_range = scores.max() - scores.min()
+    if score_range == 0:
+        return torch.zeros_like(scores)
+    return (scores - scores.min()) / score_range
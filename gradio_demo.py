@@ -1,27 +1,33 @@
 import gradio as gr
 from search_agent import vlm_rag_agent
 
-print("\n\t Loading Agent .... !\n")
-AGENT = vlm_rag_agent(gradio_demo=True)
-
 # Define the Gradio interface
-def gradio_interface(image_url, query):
-    response = AGENT.chat_with_agent(image_url, query)
-    return response
+# a generator function - gradio updates the output box with every partial response (progress + streamed tokens)
+# every browser session gets its own chat session (image, search results, output) in the shared AGENT
+def gradio_interface(image_url, query, request: gr.Request):
+    for response in AGENT.chat_with_agent_stream(image_url, query, session_id=request.session_hash):
+        yield response
 
-# Create Gradio inputs
-image_input = gr.Textbox(label="Image URL")
-query_input = gr.Textbox(label="Text Query")
-# Create Gradio output
-response_output = gr.Textbox(label="Agent Response",scale=2)
+# the agent and the UI are only created when run as a script - the page parsing workers of the scraper (forkserver / spawn)
+# import this module again, and must not create a second agent
+if __name__ == "__main__":
+    print("\n\t Loading Agent .... !\n")
+    AGENT = vlm_rag_agent(gradio_demo=True)
 
-# Define the Gradio interface
-iface = gr.Interface(
-    fn=gradio_interface,
-    inputs=[image_input, query_input],
-    outputs=response_output,
-    title="Phi3 Vision WebSearch Agent",
-    description="Provide an image URL and a text query to chat with the model."
-)
+    # Create Gradio inputs
+    image_input = gr.Textbox(label="Image URL")
+    query_input = gr.Textbox(label="Text Query")
+    # Create Gradio output
+    response_output = gr.Textbox(label="Agent Response",scale=2)
+
+    # Define the Gradio interface
+    iface = gr.Interface(
+        fn=gradio_interface,
+        inputs=[image_input, query_input],
+        outputs=response_output,
+        title="Phi3 Vision WebSearch Agent",
+        description="Provide an image URL and a text query to chat with the model."
+    )
 
-iface.launch(share=False, server_port=8080, server_name="127.0.0.1")
\ No newline at end of file
+    iface.queue(default_concurrency_limit=16)
+    iface.launch(share=False, server_port=8080, server_name="127.0.0.1")
\ No newline at end of file
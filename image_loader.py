@@ -0,0 +1,93 @@
+import hashlib
+import threading
+from io import BytesIO
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+from tracing import TRACER
+
+"""
+                                Bounded Image Loader
+
+ - the download is streamed and aborted as soon as it exceeds `max_bytes` (checked against Content-Length first)
+ - JPEGs are decoded straight at (about) the target size with draft mode (DCT scaling, 1/2 - 1/8 of the pixels),
+   other formats are resized with a reducing gap. the mode is normalized to RGB once, at load time
+ - prepared images are kept in an LRU cache of at most `max_images` images, looked up by URL (no download at all) and
+   by content hash (same image under another URL: downloaded, but not decoded again)
+Images are shared by every session that loads them, so they must not be modified in place.
+"""
+class Image_Loader():
+    def __init__(self, target_size=(384, 384), max_bytes=20 * 1024 * 1024, max_pixels=100_000_000, max_images=32, timeout=5.0):
+        self.target_size = target_size
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.max_images = max_images
+        self.timeout = timeout
+
+        self.images_by_url = OrderedDict() # {url: (image, image_hash)}
+        self.images_by_hash = {} # {image_hash: image}
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=4))
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=4))
+
+    # returns the prepared (RGB, target_size) image and the sha256 hash of the downloaded bytes
+    def load(self, image_url):
+        with self.lock:
+            if image_url in self.images_by_url:
+                self.images_by_url.move_to_end(image_url)
+                TRACER.increment('image_cache', result="url_hit")
+                return self.images_by_url[image_url]
+
+        image_bytes = self.download(image_url)
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+        with self.lock:
+            image = self.images_by_hash.get(image_hash)
+        if image is None:
+            TRACER.increment('image_cache', result="miss")
+            with TRACER.span('decode_image', num_bytes=len(image_bytes)):
+                image = self.prepare(image_bytes)
+        else:
+            TRACER.increment('image_cache', result="hash_hit")
+
+        with self.lock:
+            self.images_by_url[image_url] = (image, image_hash)
+            self.images_by_url.move_to_end(image_url)
+            self.images_by_hash[image_hash] = image
+            while len(self.images_by_url) > self.max_images:
+                self.images_by_url.popitem(last=False)
+            # drop the hashes no longer referenced by any URL
+            if len(self.images_by_hash) > len(self.images_by_url):
+                referenced = {cached_hash for cached_image, cached_hash in self.images_by_url.values()}
+                self.images_by_hash = {key: value for key, value in self.images_by_hash.items() if key in referenced}
+        return image, image_hash
+
+    def download(self, image_url):
+        with TRACER.span('download_image'):
+            with self.session.get(image_url, timeout=self.timeout, stream=True) as response:
+                response.raise_for_status()
+                content_length = response.headers.get('Content-Length')
+                if content_length is not None and int(content_length) > self.max_bytes:
+                    raise ValueError(f"Image at {image_url} is larger than {self.max_bytes} bytes ({content_length} bytes)")
+                buffer = BytesIO()
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    buffer.write(chunk)
+                    if buffer.tell() > self.max_bytes:
+                        raise ValueError(f"Image at {image_url} is larger than {self.max_bytes} bytes")
+                return buffer.getvalue()
+
+    def prepare(self, image_bytes):
+        image = Image.open(BytesIO(image_bytes))
+        if image.width * image.height > self.max_pixels:
+            raise ValueError(f"Image of {image.width}x{image.height} pixels exceeds the limit of {self.max_pixels} pixels")
+        # JPEG only (no-op for other formats): the decoder scales down by up to 8x while still covering the target size
+        image.draft('RGB', self.target_size)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        return image.resize(self.target_size, Image.Resampling.BICUBIC, reducing_gap=3.0)
+
+    def __len__(self):
+        return len(self.images_by_url)
@@ -0,0 +1,215 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+import numpy as np
+
+"""
+                                Persistent Knowledge Base of Wikipedia Passages
+
+Passages scraped for any image are kept across images (and restarts), so a page that is already known is never scraped
+or embedded again.
+ - SQLite (`passages.sqlite`) : page URL/title + passage text, one row per passage (row id = passage_id)
+ - vectors (`vectors.npy`)    : float16 matrix memory-mapped from disk, row `passage_id` = passage vector
+ - ANN index                  : inverted file (IVF) over the vectors, used for searches over the whole store
+
+A passage vector is the sum of the Contriever embeddings of its sentences, so `query_embedding @ passage_vector` is
+exactly the relevance score computed by Contriever_Model.compute_relevance_scores.
+The vectors are only valid for the retriever that produced them: the model id and embedding size are kept in the `meta`
+table, and if the store is opened for another retriever the vectors are dropped (the passages are kept and re-embedded).
+"""
+class Passage_Store():
+    def __init__(self, store_dir='.passage_store', embedding_dim=768, model_id='facebook/contriever', initial_capacity=65536, num_probes=8):
+        self.store_dir = store_dir
+        self.embedding_dim = embedding_dim
+        self.model_id = model_id
+        self.initial_capacity = initial_capacity
+        self.num_probes = num_probes
+        os.makedirs(store_dir, exist_ok=True)
+
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(os.path.join(store_dir, 'passages.sqlite'), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, title TEXT, stored_at REAL)")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS passages (
+                                passage_id INTEGER PRIMARY KEY,
+                                url TEXT,
+                                title TEXT,
+                                content TEXT,
+                                has_vector INTEGER DEFAULT 0)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS passages_url ON passages (url)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+
+        vectors_path = os.path.join(store_dir, 'vectors.npy')
+        stored_retriever = dict(self.db.execute("SELECT key, value FROM meta").fetchall())
+        if os.path.exists(vectors_path) and stored_retriever == self.retriever_metadata():
+            self.vectors = np.load(vectors_path, mmap_mode='r+')
+        else:
+            if os.path.exists(vectors_path):
+                logging.warning(f"Passage store {store_dir} was embedded with {stored_retriever or 'an unknown retriever'}, "
+                                f"dropping its vectors (re-embedded with {self.retriever_metadata()})")
+            self.reset_vectors()
+
+        # IVF index - built lazily on the first search over the whole store, rebuilt whenever the store doubles in size
+        self.centroids = None
+        self.inverted_lists = None
+        self.num_indexed = 0
+
+    def retriever_metadata(self):
+        return {'model_id': self.model_id, 'embedding_dim': str(self.embedding_dim)}
+
+    # new (empty) vector matrix for the current retriever, every passage is embedded again when it is next scored
+    def reset_vectors(self):
+        vectors_path = os.path.join(self.store_dir, 'vectors.npy')
+        self.vectors = np.lib.format.open_memmap(vectors_path, mode='w+', dtype=np.float16, shape=(self.initial_capacity, self.embedding_dim))
+        with self.lock:
+            self.db.execute("UPDATE passages SET has_vector = 0")
+            self.db.execute("DELETE FROM meta")
+            self.db.executemany("INSERT INTO meta VALUES (?, ?)", list(self.retriever_metadata().items()))
+            self.db.commit()
+
+    #### pages & passages ####
+
+    def has_page(self, url):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM pages WHERE url = ?", (url,)).fetchone() is not None
+
+    # a page that is scraped again replaces its passages (new ids), the old ids are also removed from the inverted lists
+    # so that an ANN search never spends candidate slots on passages that no longer exist
+    def add_page(self, url, title, contents):
+        with self.lock:
+            stale_ids = {row[0] for row in self.db.execute("SELECT passage_id FROM passages WHERE url = ?", (url,))}
+            if len(stale_ids) > 0 and self.inverted_lists is not None:
+                self.inverted_lists = [[passage_id for passage_id in inverted_list if passage_id not in stale_ids] for inverted_list in self.inverted_lists]
+            self.db.execute("DELETE FROM passages WHERE url = ?", (url,))
+            self.db.executemany("INSERT INTO passages (url, title, content) VALUES (?, ?, ?)", [(url, title, content) for content in contents])
+            self.db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)", (url, title, time.time()))
+            self.db.commit()
+        return self.get_passages(url)
+
+    # passages of a page in the same format as Scraper.extract_webpage_contents (+ passage_id)
+    def get_passages(self, url):
+        with self.lock:
+            rows = self.db.execute("SELECT passage_id, title, url, content FROM passages WHERE url = ? ORDER BY passage_id", (url,)).fetchall()
+        return [{'Title': title, 'URL': url, 'content': content, 'passage_id': passage_id} for passage_id, title, url, content in rows]
+
+    def get_passages_by_id(self, passage_ids):
+        if len(passage_ids) == 0:
+            return []
+        with self.lock:
+            rows = self.db.execute(f"SELECT passage_id, title, url, content FROM passages WHERE passage_id IN ({','.join('?' * len(passage_ids))})", passage_ids).fetchall()
+        passages = {passage_id: {'Title': title, 'URL': url, 'content': content, 'passage_id': passage_id} for passage_id, title, url, content in rows}
+        return [passages[passage_id] for passage_id in passage_ids if passage_id in passages]
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM passages").fetchone()[0]
+
+    #### vectors ####
+
+    # returns the vectors of the given passages (float32) and a boolean mask of the passages that already have a vector
+    def get_vectors(self, passage_ids):
+        if len(passage_ids) == 0:
+            return np.zeros((0, self.embedding_dim), dtype=np.float32), np.zeros(0, dtype=bool)
+        with self.lock:
+            rows = self.db.execute(f"SELECT passage_id FROM passages WHERE has_vector = 1 AND passage_id IN ({','.join('?' * len(passage_ids))})", passage_ids).fetchall()
+            with_vector = {row[0] for row in rows}
+            has_vector = np.array([passage_id in with_vector for passage_id in passage_ids], dtype=bool)
+            vectors = np.zeros((len(passage_ids), self.embedding_dim), dtype=np.float32)
+            ids = np.array(passage_ids, dtype=np.int64)
+            vectors[has_vector] = self.vectors[ids[has_vector]]
+        return vectors, has_vector
+
+    def set_vectors(self, passage_ids, vectors):
+        if len(passage_ids) == 0:
+            return
+        with self.lock:
+            self._ensure_capacity(max(passage_ids) + 1)
+            self.vectors[np.array(passage_ids, dtype=np.int64)] = vectors.astype(np.float16)
+            self.vectors.flush()
+            self.db.executemany("UPDATE passages SET has_vector = 1 WHERE passage_id = ?", [(passage_id,) for passage_id in passage_ids])
+            self.db.commit()
+            # new vectors are added to the inverted list of their nearest centroid
+            if self.centroids is not None:
+                self._assign_to_lists(np.array(passage_ids, dtype=np.int64), vectors)
+
+    # grow the memory-mapped matrix (capacity doubles) when passage ids run past its end
+    def _ensure_capacity(self, num_rows):
+        if num_rows <= len(self.vectors):
+            return
+        capacity = len(self.vectors)
+        while capacity < num_rows:
+            capacity *= 2
+        vectors_path = os.path.join(self.store_dir, 'vectors.npy')
+        grown = np.lib.format.open_memmap(vectors_path + '.tmp', mode='w+', dtype=np.float16, shape=(capacity, self.embedding_dim))
+        grown[:len(self.vectors)] = self.vectors
+        grown.flush()
+        del grown
+        self.vectors = None
+        os.replace(vectors_path + '.tmp', vectors_path)
+        self.vectors = np.load(vectors_path, mmap_mode='r+')
+
+    #### search ####
+
+    # top-K passages for the query embedding
+    #  - urls given : exact search restricted to the passages of these pages (cost proportional to these pages only)
+    #  - urls=None  : approximate search over the whole store with the IVF index (only `num_probes` lists are scanned)
+    def search(self, query_embedding, K=10, urls=None):
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        if urls is not None and len(urls) == 0:
+            return []
+        with self.lock:
+            if urls is not None:
+                rows = self.db.execute(f"SELECT passage_id FROM passages WHERE has_vector = 1 AND url IN ({','.join('?' * len(urls))})", list(urls)).fetchall()
+                candidate_ids = np.array([row[0] for row in rows], dtype=np.int64)
+            else:
+                candidate_ids = self._ann_candidates(query_embedding)
+            if len(candidate_ids) == 0:
+                return []
+            scores = self.vectors[candidate_ids].astype(np.float32) @ query_embedding
+
+        top = np.argsort(-scores)[:K]
+        passages = {passage['passage_id']: passage for passage in self.get_passages_by_id([int(passage_id) for passage_id in candidate_ids[top]])}
+        return [(passages[int(passage_id)], float(score)) for passage_id, score in zip(candidate_ids[top], scores[top]) if int(passage_id) in passages]
+
+    def _ann_candidates(self, query_embedding):
+        with self.lock:
+            num_vectors = self.db.execute("SELECT COUNT(*) FROM passages WHERE has_vector = 1").fetchone()[0]
+            if self.centroids is None or num_vectors > 2 * self.num_indexed:
+                self.build_index()
+            if self.centroids is None:
+                return np.zeros(0, dtype=np.int64)
+            probes = np.argsort(-(self.centroids @ query_embedding))[:self.num_probes]
+            return np.concatenate([np.array(self.inverted_lists[probe], dtype=np.int64) for probe in probes])
+
+    # spherical k-means over (a sample of) the stored vectors, then every vector is assigned to its nearest centroid
+    def build_index(self, num_lists=None, num_iterations=10, max_training_vectors=50000):
+        with self.lock:
+            passage_ids = np.array([row[0] for row in self.db.execute("SELECT passage_id FROM passages WHERE has_vector = 1")], dtype=np.int64)
+            if len(passage_ids) == 0:
+                return
+            num_lists = num_lists or max(1, int(np.sqrt(len(passage_ids))))
+
+            rng = np.random.default_rng(0)
+            sample = self.vectors[np.sort(rng.choice(passage_ids, size=min(len(passage_ids), max_training_vectors), replace=False))].astype(np.float32)
+            sample /= np.linalg.norm(sample, axis=1, keepdims=True) + 1e-6
+            centroids = sample[rng.choice(len(sample), size=min(num_lists, len(sample)), replace=False)]
+            for _ in range(num_iterations):
+                assignment = np.argmax(sample @ centroids.T, axis=1)
+                for list_id in range(len(centroids)):
+                    members = sample[assignment == list_id]
+                    if len(members) > 0:
+                        centroid = members.sum(axis=0)
+                        centroids[list_id] = centroid / (np.linalg.norm(centroid) + 1e-6)
+
+            self.centroids = centroids
+            self.inverted_lists = [[] for _ in range(len(centroids))]
+            for start in range(0, len(passage_ids), 65536):
+                batch_ids = passage_ids[start:start + 65536]
+                self._assign_to_lists(batch_ids, self.vectors[batch_ids].astype(np.float32))
+            self.num_indexed = len(passage_ids)
+
+    def _assign_to_lists(self, passage_ids, vectors):
+        for passage_id, list_id in zip(passage_ids.tolist(), np.argmax(vectors @ self.centroids.T, axis=1).tolist()):
+            self.inverted_lists[list_id].append(passage_id)
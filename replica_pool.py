@@ -0,0 +1,107 @@
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+
+import requests
+
+"""
+                                Pool of VLM Server Replicas
+
+The same model can be served by several servers (GPUs / nodes). Every call is routed to one replica:
+ - power-of-two-choices : two random healthy replicas are drawn and the one with fewer outstanding requests is used
+ - health checks        : every `health_check_interval` seconds each replica is probed on /ready (200 = model loaded).
+                          a replica failing a call or a probe is ejected, and re-admitted as soon as a probe succeeds
+ - failover             : a call that fails on a replica (connection error, timeout, 5xx) is sent to another replica
+If every replica is ejected, all of them are used again (the health state may just be stale).
+"""
+class Replica():
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.requests = 0
+
+
+class Replica_Pool():
+    def __init__(self, urls, health_check_interval=5.0, health_check_timeout=2.0):
+        assert len(urls) > 0, "A replica pool needs at least one server URL"
+        self.replicas = [Replica(url.rstrip('/')) for url in urls]
+        self.health_check_timeout = health_check_timeout
+        self.lock = threading.Lock()
+
+        # a single server has nothing to fail over to, it is not probed
+        if len(self.replicas) > 1 and health_check_interval is not None:
+            self.health_check_interval = health_check_interval
+            threading.Thread(target=self._health_check_loop, daemon=True).start()
+
+    def __len__(self):
+        return len(self.replicas)
+
+    # power-of-two-choices among the healthy replicas that were not tried yet for this call
+    def choose(self, exclude=()):
+        with self.lock:
+            candidates = [replica for replica in self.replicas if replica not in exclude]
+            healthy = [replica for replica in candidates if replica.healthy]
+            candidates = healthy or candidates
+            if len(candidates) == 0:
+                return None
+            if len(candidates) == 1:
+                return candidates[0]
+            first, second = random.sample(candidates, 2)
+            return first if first.outstanding <= second.outstanding else second
+
+    # replicas in the order they are tried for one call (the next one is chosen only when the previous one failed)
+    def failover_order(self):
+        tried = []
+        while len(tried) < len(self.replicas):
+            replica = self.choose(exclude=tried)
+            if replica is None:
+                return
+            tried.append(replica)
+            yield replica
+
+    @contextmanager
+    def track(self, replica):
+        with self.lock:
+            replica.outstanding += 1
+            replica.requests += 1
+        try:
+            yield replica
+        finally:
+            with self.lock:
+                replica.outstanding -= 1
+
+    def mark_failure(self, replica, reason):
+        with self.lock:
+            replica.failures += 1
+            was_healthy, replica.healthy = replica.healthy, False
+        if was_healthy and len(self.replicas) > 1:
+            logging.warning(f"VLM replica {replica.url} ejected: {reason}")
+
+    def mark_success(self, replica):
+        with self.lock:
+            replica.healthy = True
+
+    def probe(self, replica):
+        try:
+            healthy = requests.get(f"{replica.url}/ready", timeout=self.health_check_timeout).status_code == 200
+        except requests.exceptions.RequestException:
+            healthy = False
+        with self.lock:
+            if healthy and not replica.healthy:
+                logging.info(f"VLM replica {replica.url} re-admitted")
+            replica.healthy = healthy
+
+    def _health_check_loop(self):
+        while True:
+            for replica in self.replicas:
+                self.probe(replica)
+            time.sleep(self.health_check_interval)
+
+    def stats(self):
+        with self.lock:
+            return [{'url': replica.url, 'healthy': replica.healthy, 'outstanding': replica.outstanding,
+                     'requests': replica.requests, 'failures': replica.failures} for replica in self.replicas]
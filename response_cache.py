@@ -0,0 +1,82 @@
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from scraper_cache import Disk_Cache
+from tracing import TRACER
+
+"""
+                                VLM Response Cache
+
+With deterministic decoding the same request always gets the same response, so it is only generated once:
+ - the key is the hash of the model name, endpoint, image content hash, full prompt and generation parameters
+ - an in-memory LRU tier of `max_entries` responses, backed by an on-disk tier (SQLite, see scraper_cache.py) that
+   survives restarts and can be shared by several agents (cache_dir=None keeps the cache in memory only)
+ - requests with sampling enabled (do_sample=True) bypass the cache
+Hits / misses / bypasses are counted in stats() and in the `vlm_response_cache` counter of the tracer.
+"""
+class Response_Cache():
+    def __init__(self, max_entries=1024, cache_dir='.vlm_response_cache', ttl=7 * 24 * 3600, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.memory = OrderedDict() # {key: response}
+        self.lock = threading.Lock()
+        self.disk = Disk_Cache(cache_dir, ttl=ttl, max_bytes=max_bytes) if cache_dir is not None else None
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypasses = 0
+
+    # returns the cache key of the request, or None if the request must not be cached (sampling enabled)
+    def key(self, model_name, endpoint, image_hash, query, **generation):
+        if generation.get('do_sample', False):
+            with self.lock:
+                self.bypasses += 1
+            TRACER.increment('vlm_response_cache', result="bypass")
+            return None
+        request = {'model': model_name, 'endpoint': endpoint, 'image': image_hash, 'query': query, 'generation': generation}
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+    # returns the cached response or None
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                TRACER.increment('vlm_response_cache', result="memory_hit")
+                return self.memory[key]
+
+        entry = self.disk.get(key) if self.disk is not None else None
+        if entry is not None and entry.fresh:
+            response = json.loads(entry.value.decode('utf-8'))
+            with self.lock:
+                self.disk_hits += 1
+                self.store_in_memory(key, response)
+            TRACER.increment('vlm_response_cache', result="disk_hit")
+            return response
+
+        with self.lock:
+            self.misses += 1
+        TRACER.increment('vlm_response_cache', result="miss")
+        return None
+
+    def put(self, key, response):
+        with self.lock:
+            self.store_in_memory(key, response)
+        if self.disk is not None:
+            self.disk.put(key, json.dumps(response).encode('utf-8'))
+
+    def store_in_memory(self, key, response):
+        self.memory[key] = response
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            stats = {'memory_entries': len(self.memory), 'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits,
+                     'misses': self.misses, 'bypasses': self.bypasses}
+        if self.disk is not None:
+            stats['disk'] = self.disk.stats()
+        return stats
@@ -0,0 +1,85 @@
+import os
+import time
+import zlib
+import sqlite3
+import threading
+from collections import namedtuple
+
+"""
+                                On-disk Cache for the Scraper
+
+Reverse image search results (keyed by image URL / image content hash) and raw web page bodies (keyed by URL) are stored
+zlib-compressed in a single SQLite file, so hot images are answered with zero outbound requests.
+ - entries older than `ttl` seconds are stale. stale pages with an ETag / Last-Modified header are revalidated
+   with a conditional request instead of being downloaded again
+ - when the compressed size of all entries exceeds `max_bytes`, the least recently used entries are evicted
+"""
+Cache_Entry = namedtuple('Cache_Entry', ['value', 'etag', 'last_modified', 'fresh'])
+
+class Disk_Cache():
+    def __init__(self, cache_dir='.scraper_cache', ttl=24 * 3600, max_bytes=512 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'cache.sqlite'), check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS cache (
+                                key TEXT PRIMARY KEY,
+                                value BLOB,
+                                etag TEXT,
+                                last_modified TEXT,
+                                stored_at REAL,
+                                accessed_at REAL,
+                                size INTEGER)""")
+        self.db.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    # returns a Cache_Entry (fresh=False if the entry is older than the ttl) or None
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value, etag, last_modified, stored_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.db.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+        value, etag, last_modified, stored_at = row
+        fresh = time.time() - stored_at < self.ttl
+        if fresh:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return Cache_Entry(zlib.decompress(value), etag, last_modified, fresh)
+
+    def put(self, key, value, etag=None, last_modified=None):
+        compressed = zlib.compress(value)
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?, ?)", (key, compressed, etag, last_modified, now, now, len(compressed)))
+            self.evict()
+            self.db.commit()
+
+    # the entry was revalidated by the server (304 Not Modified) - it is fresh again
+    def touch(self, key):
+        with self.lock:
+            self.db.execute("UPDATE cache SET stored_at = ?, accessed_at = ? WHERE key = ?", (time.time(), time.time(), key))
+            self.db.commit()
+
+    # evict the least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        total_size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        for key, size in self.db.execute("SELECT key, size FROM cache ORDER BY accessed_at ASC").fetchall():
+            if total_size <= self.max_bytes:
+                break
+            self.db.execute("DELETE FROM cache WHERE key = ?", (key,))
+            total_size -= size
+
+    def stats(self):
+        with self.lock:
+            num_entries, total_size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        return {'entries': num_entries, 'compressed_bytes': total_size, 'hits': self.hits, 'misses': self.misses}
@@ -1,159 +1,416 @@
-from web_scraper import Scraper
-from contriever_wrapper import Contriever_Model
+from web_scraper import Scraper, No_Search_Results
 from server_apis import My_VLM_APIs
-
-from PIL import Image
-import requests
-from io import BytesIO
+from chat_session import Session_Store
+from passage_store import Passage_Store
+from bm25_index import BM25_Index
+from tracing import TRACER
+from image_loader import Image_Loader
+from context_packer import Context_Packer
+from response_cache import Response_Cache
+
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import textwrap3
 
 class vlm_rag_agent():
-    def __init__(self, gradio_demo=False):
+    def __init__(self, gradio_demo=False, concurrent_contexts=True, max_in_flight=4, session_idle_timeout=30 * 60,
+                 max_contexts=10, min_contexts=3, adaptive_K_gap=None, question_deadline=None, target_verified_answers=None,
+                 context_token_budget=1536, vlm_base_url=None, retriever_model_id='facebook/contriever', background_init=True,
+                 cache_vlm_responses=True, response_cache_dir='.vlm_response_cache', retriever_device=None, retriever_batch_size=64,
+                 retriever_quantize=None, retriever_num_threads=None):
 
         # whether to print result (for chat.py) or return a one large response string (for gradio_demo.py)
         self.gradio_demo = gradio_demo
-        self.gradio_string = ""
 
-        # initialize the search tool
-        self.scraper = Scraper()
+        # every scraped passage is also added to a BM25 index, so the contriever only embeds the lexically best candidates
+        self.bm25_index = BM25_Index()
 
-        # using the VLMs as APIs (implemented using FastAPI framework) enables faster prototyping and you can also share the same VLM between multiple agents
-        self.vlm = My_VLM_APIs(model_name='phi3_vision')
+        # initialize the search tool (the passage store is attached once the retriever is loaded)
+        self.scraper = Scraper(bm25_index=self.bm25_index)
 
         # contriever model is pretty small and quickly loads into a GPU, so no need to create an API server for this
-        self.contriever = Contriever_Model()
+        # torch / transformers / nltk are imported and the weights loaded in a background thread (background_init=True), so the
+        # agent is ready at once - the retriever is only waited for when the first SEARCH turn needs it
+        # retriever_device / retriever_batch_size / retriever_quantize are passed on to Contriever_Model (see contriever_wrapper.py).
+        # retriever_num_threads sets the number of torch CPU threads of the whole process (torch.set_num_threads is global), once
+        retriever_settings = {'device': retriever_device, 'batch_size': retriever_batch_size, 'quantize': retriever_quantize}
+        self.contriever = None
+        self.passage_store = None
+        self.retriever_ready = threading.Event()
+        self.retriever_error = None
+        if background_init:
+            threading.Thread(target=self.load_retriever, args=(retriever_model_id, retriever_settings, retriever_num_threads), daemon=True).start()
+        else:
+            self.load_retriever(retriever_model_id, retriever_settings, retriever_num_threads)
 
-        # placeholder for image
-        self.image = None
-        # used to check if new (image & search results) must be loaded or current (image & search results) is enough!
-        self.currently_active_image_url = ""
-        self.is_search_results_available_for_currently_active_image_url = False
+        # images are downloaded with a size cap, decoded at the target size and cached (switching back to an image is instant)
+        self.image_loader = Image_Loader(target_size=(384, 384))
+
+        # using the VLMs as APIs (implemented using FastAPI framework) enables faster prototyping and you can also share the same VLM between multiple agents
+        # deterministic VLM calls (same image, prompt and generation controls) are answered from a memory + on-disk cache, so a
+        # repeated question or self-check costs nothing (response_cache_dir=None keeps the cache in memory only)
+        response_cache = Response_Cache(cache_dir=response_cache_dir) if cache_vlm_responses else None
+        self.vlm = My_VLM_APIs(model_name='phi3_vision', base_url=vlm_base_url, response_cache=response_cache)
+
+        # answer/self-check the top-K contexts concurrently, with at most max_in_flight contexts being processed by the VLM server at once
+        self.concurrent_contexts = concurrent_contexts
+        self.max_in_flight = max_in_flight
+
+        # budget of a SEARCH turn
+        #  - at most max_contexts contexts are retrieved. with adaptive_K_gap, the list is cut (after at least min_contexts) at the
+        #    first drop between consecutive contriever scores larger than adaptive_K_gap * (highest score - lowest score)
+        #  - question_deadline (seconds, from the moment the question is asked) / target_verified_answers stop the turn early,
+        #    contexts not yet sent to the VLM are cancelled and the verified answers found so far are returned
+        self.max_contexts = max_contexts
+        self.min_contexts = min_contexts
+        self.adaptive_K_gap = adaptive_K_gap
+        self.question_deadline = question_deadline
+        self.target_verified_answers = target_verified_answers
+
+        # the retrieved passages are packed into VLM calls of at most context_token_budget tokens each (with [n] citation markers),
+        # so a turn needs a few large calls instead of one call per passage. context_token_budget=None sends every passage on its own
+        self.context_packer = None if context_token_budget is None else Context_Packer(token_budget=context_token_budget)
+
+        # image, search results and output of every chat are held in a per-session state (see chat_session.py)
+        self.sessions = Session_Store(idle_timeout=session_idle_timeout)
 
         # complete set of prompts used by this agent
         self.prompt_store = {
                 "tool_use_prompt": "[Instruction] For the given image, strictly answer the following question if only if you are confident that your answer is correct. If you are not confident about your answer (or) the image/question is beyond your understanding, reply with '[SEARCH]' to leverage external search tools.\n[Question] {}",
                 "get_contriever_search_keywords": "[Question] {}.\n[Instruction] To help you answer this question, there is an external search tool available. However, the tool cannot understand complex queries and can only accept keywords to retrieve relevant contexts. Now, for the given Image and the corresponding Question, reply with the appropriate keywords that can retieve the most informative contexts.  Strictly reply with NO MORE THAN FIVE keywords.",
                 "answer_with_context_prompt": "[Instruction] The following passage contains the response from an external search tool.\n[Search Tool Response] {} If the passage does not provide sufficient information to answer the following question, reply with [SKIP PASSAGE] to skip to the next.\n[Question] {}",
+                "answer_with_packed_contexts_prompt": "[Instruction] The following passages, each starting with a marker such as [1], contain the response from an external search tool.\n[Search Tool Response] {}\nIf the passages do not provide sufficient information to answer the following question, reply with [SKIP PASSAGE] to skip to the next. Otherwise answer the question and cite the markers of the passages that support your answer.\n[Question] {}",
                 "self_check": "\n[Context] {}.\n[Response] {}.\n[Instruction] You need to validate if the above response is clearly and unambiguously supported by the prior context. If the response is supported by context reply with [OK]. If the response does not provide sufficient information or is not supported by the context, reply with [NOT SUPPORTED].",
                 "concistency_check": "[Question] {}.\n[Instruction] For the above question the following responses were supported by various contexts. You need to aggregate the information in all the following responses (strictly do not add any new information) and reply with a coherent and consistent final response. {}",
             }
 
+        # per-prompt generation controls - routing replies ([SEARCH], [SKIP PASSAGE]) stop as soon as they are generated
+        self.generation_store = {
+                "tool_use_prompt": {"stop": ["[SEARCH]"]},
+                "get_contriever_search_keywords": {"max_new_tokens": 32},
+                "answer_with_context_prompt": {"stop": ["[SKIP PASSAGE]"]},
+                "answer_with_packed_contexts_prompt": {"stop": ["[SKIP PASSAGE]"]},
+            }
+        # the self-check reply is picked from these labels in a single forward pass (no decoding)
+        self.self_check_labels = ["[OK]", "[NOT SUPPORTED]"]
+
+    def load_retriever(self, retriever_model_id, retriever_settings=None, num_threads=None):
+        try:
+            import torch
+            from contriever_wrapper import Contriever_Model # deferred import (torch, transformers, nltk)
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            contriever = Contriever_Model(bm25_index=self.bm25_index, model_id=retriever_model_id, **(retriever_settings or {}))
+            contriever.warm_up()
+
+            # passages of every scraped page are kept across images (and restarts), so known pages are never scraped or embedded again
+            # (the stored passage vectors are only reused by the same retriever model, see passage_store.py)
+            self.passage_store = Passage_Store(embedding_dim=contriever.model.config.hidden_size, model_id=retriever_model_id)
+            contriever.passage_store = self.passage_store
+            self.scraper.passage_store = self.passage_store
+            self.contriever = contriever
+        except Exception as e:
+            self.retriever_error = e
+            logging.error(f"Failed to load the retriever: {e}")
+        finally:
+            self.retriever_ready.set()
+
+    # blocks until the background initialization of the retriever is done
+    def wait_for_retriever(self):
+        self.retriever_ready.wait()
+        if self.retriever_error is not None:
+            raise RuntimeError("The retriever could not be loaded") from self.retriever_error
+        return self.contriever
+
+    # returns the image and its content hash (the search results are cached under it)
     def load_image(self, image_url):
-        image = Image.open(BytesIO(requests.get(image_url,timeout=5.0).content))
-        image = image.resize((384,384))
-        return image
+        with TRACER.span('load_image'):
+            return self.image_loader.load(image_url)
     
-    def perform_reverse_image_search(self, image_url, print_search_results=False):
+    # returns the text paragraphs extracted from the search results (the corpus of the current image)
+    def perform_reverse_image_search(self, image_url, image_hash=None, print_search_results=False):
         # get search results
-        search_results = self.scraper.get_search_result(image_url)
+        with TRACER.span('reverse_image_search'):
+            search_results = self.scraper.get_search_result(image_url, image_hash=image_hash)
         if print_search_results:
             for key, value in search_results.items():
                 print(f'{key} Title: {value["Title"]}\n{key} URL: {value["URL"]}\n')
-        # extract webpage contents from search results - saved by default to 'parsed_search_results.json'
-        self.scraper.extract_webpage_contents(search_results)
+        # extract webpage contents from search results
+        with TRACER.span('extract_webpage_contents', num_pages=len(search_results)):
+            return self.scraper.extract_webpage_contents(search_results)
+
+    # instruct vlm to answer the query with the supporting context, then double check the answer against the same context
+    # returns (agent_response, self_check_response) - self_check_response is None if the passage was skipped (or the turn was cancelled)
+    # (prompt_type = answer_with_context_prompt for a single passage, answer_with_packed_contexts_prompt for a pack of passages)
+    # returns (answer, self-check response), None if the turn stopped before the answer call
+    # the turn is checked before each VLM call, so a stopped turn starts no new call (the self-check response is then None)
+    def answer_and_verify(self, image, context, question, cancelled=None, deadline=None, prompt_type="answer_with_context_prompt"):
+        if self.turn_stopped(cancelled, deadline):
+            return None
+        query = self.prompt_store[prompt_type].format(context, question)
+        with TRACER.span('vlm_call', prompt_type=prompt_type):
+            agent_response = self.vlm.get_response(image, query, **self.generation_store[prompt_type])
+        if "SKIP PASSAGE" in agent_response or self.turn_stopped(cancelled, deadline):
+            return agent_response, None
+        query = self.prompt_store["self_check"].format(context, agent_response)
+        with TRACER.span('vlm_call', prompt_type="self_check"):
+            return agent_response, self.vlm.classify(image, query, self.self_check_labels)
+
+    # the SEARCH turn was cancelled (enough verified answers) or its deadline (time.monotonic() value) passed
+    @staticmethod
+    def turn_stopped(cancelled=None, deadline=None):
+        return (cancelled is not None and cancelled.is_set()) or (deadline is not None and time.monotonic() >= deadline)
+
+    @staticmethod
+    def is_verified(self_check_response):
+        return self_check_response is not None and "OK" in self_check_response
+
+    # number of contexts to process: cut the relevance-sorted list at the first large drop of the contriever score
+    def adaptive_K(self, relevance_scores):
+        if self.adaptive_K_gap is None or len(relevance_scores) <= self.min_contexts:
+            return len(relevance_scores)
+        score_range = relevance_scores[0] - relevance_scores[-1]
+        for i in range(self.min_contexts, len(relevance_scores)):
+            if relevance_scores[i - 1] - relevance_scores[i] > self.adaptive_K_gap * score_range:
+                return i
+        return len(relevance_scores)
+
+    # each context runs its answer -> self-check chain independently, so a self-check starts as soon as its answer arrives
+    # contexts are submitted in relevance order as the previous ones finish (at most max_in_flight at once, one at a time if
+    # not concurrent_contexts), and only while the turn goes on: once the deadline (time.monotonic() value) passes or
+    # target_verified_answers answers are verified no context is submitted anymore, and the in-flight ones start no further
+    # VLM call (an in-flight VLM request still completes on the server, its result is dropped)
+    # results are returned in the original (relevance) order of the contexts, None for the contexts that were not processed
+    def process_contexts(self, image, contexts, question, deadline=None, target_verified_answers=None, prompt_type="answer_with_context_prompt"):
+        results = [None] * len(contexts)
+        cancelled = threading.Event()
+        max_in_flight = self.max_in_flight if self.concurrent_contexts else 1
+        executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        pending_contexts = iter(enumerate(contexts))
+        futures = {}
+        num_verified_answers = 0
+        try:
+            while True:
+                while len(futures) < max_in_flight and not self.turn_stopped(cancelled, deadline):
+                    i, context = next(pending_contexts, (None, None))
+                    if i is None:
+                        break
+                    futures[executor.submit(TRACER.wrap(self.answer_and_verify, 'context', context_index=i), image, context, question, cancelled, deadline, prompt_type)] = i
+                if len(futures) == 0:
+                    break
+                done, _ = wait(futures, timeout=None if deadline is None else max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+                if len(done) == 0:
+                    break
+                for future in done:
+                    i = futures.pop(future)
+                    results[i] = future.result()
+                    num_verified_answers += results[i] is not None and self.is_verified(results[i][1])
+                if target_verified_answers is not None and num_verified_answers >= target_verified_answers:
+                    break
+        finally:
+            cancelled.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+        if self.turn_stopped(deadline=deadline) and any(result is None for result in results):
+            logging.warning(f"SEARCH turn deadline exceeded, {sum(result is not None for result in results)}/{len(contexts)} contexts were processed.")
+        return results
 
     # print results directly in terminal (or) format as a string and send to gradio 
-    def print_output_or_format_string(self, content):
+    def print_output_or_format_string(self, session, content):
         if not self.gradio_demo:
             print(textwrap3.fill(content),width=180)
         else:
-            self.gradio_string += f"\n{content}"
+            session.gradio_string += f"\n{content}"
+
+    # get the complete vlm response, or (stream=True) yield the partial response as the tokens arrive
+    # use as `agent_response = yield from self.get_vlm_response(image, query, stream, **generation)`
+    def get_vlm_response(self, image, query, stream=False, **generation):
+        if not stream:
+            return self.vlm.get_response(image, query, **generation)
+        agent_response = ""
+        for chunk in self.vlm.stream_response(image, query, **generation):
+            agent_response += chunk
+            yield agent_response
+        return agent_response
+
+    # agent_workflow traced as one chat turn (see tracing.py), iterate it with TRACER.iterate
+    def traced_workflow(self, session, image_url, question, stream=False):
+        with TRACER.span('chat_turn', session_id=session.session_id, stream=stream):
+            yield from self.agent_workflow(session, image_url, question, stream)
+
+    # session_id identifies the chat (e.g. one per gradio user), chats with different session_ids run independently
+    def chat_with_agent(self, image_url, question, session_id="default"):
+        session = self.sessions.get_session(session_id)
+        with session.lock:
+            for _ in TRACER.iterate(self.traced_workflow(session, image_url, question)):
+                pass
+            if self.gradio_demo:
+                gradio_string_copy = session.gradio_string
+                session.gradio_string = "" # reset after answering a query
+                return gradio_string_copy
+
+    # generator version of chat_with_agent for gradio_demo.py
+    # yields the output formatted so far (+ the partial response of the VLM call in progress) after every step / streamed token
+    def chat_with_agent_stream(self, image_url, question, session_id="default"):
+        session = self.sessions.get_session(session_id)
+        with session.lock:
+            try:
+                for partial_response in TRACER.iterate(self.traced_workflow(session, image_url, question, stream=True)):
+                    yield session.gradio_string + (f"\n\n{partial_response}" if partial_response else "")
+                yield session.gradio_string
+            finally:
+                session.gradio_string = "" # reset after answering a query
 
     """
     This is where the complete Agentic workflow is defined!
     Note that current version does not maintain a chat history (enables with VLMs having limited context window)
+    The workflow is a generator that yields after every step, so that the progress (and streamed tokens) can be pushed to the UI
     """
-    def chat_with_agent(self, image_url, question):
+    def agent_workflow(self, session, image_url, question, stream=False):
+
+        # the deadline of a SEARCH turn counts from the moment the question is asked
+        deadline = None if self.question_deadline is None else time.monotonic() + self.question_deadline
 
         # 
         #### load the new image every time a new image_url is provided ####
         # 
-        if image_url == self.currently_active_image_url:
+        if image_url == session.currently_active_image_url:
             pass
         else:
-            self.print_output_or_format_string(f"\n Loading new image!")
-            self.image = self.load_image(image_url)
-            self.currently_active_image_url = image_url
-            self.is_search_results_available_for_currently_active_image_url = False
+            self.print_output_or_format_string(session, f"\n Loading new image!")
+            session.image, session.image_hash = self.load_image(image_url)
+            session.currently_active_image_url = image_url
+            session.is_search_results_available_for_currently_active_image_url = False
+            session.corpus = []
+            yield ""
     
         # 
         #### First check if the question can be answered directly or if an external search tool is required! ####
         # 
         query = self.prompt_store["tool_use_prompt"].format(question)
-        agent_response = self.vlm.get_response(self.image, query)
+        with TRACER.span('vlm_call', prompt_type="tool_use_prompt"):
+            agent_response = yield from self.get_vlm_response(session.image, query, stream, **self.generation_store["tool_use_prompt"])
 
         if "SEARCH" in agent_response:
 
-            self.print_output_or_format_string(f"\n Initial Response: {agent_response}")
+            self.print_output_or_format_string(session, f"\n Initial Response: {agent_response}")
+            yield ""
 
             # 
             #### get search results only once whenever a new image_url is provided ####
             # 
-            if image_url == self.currently_active_image_url and self.is_search_results_available_for_currently_active_image_url == True:
+            if image_url == session.currently_active_image_url and session.is_search_results_available_for_currently_active_image_url == True:
                 pass
             else:
-                self.print_output_or_format_string(f"\n Performing Reverse Image Search over the internet!")
-                self.perform_reverse_image_search(image_url)
-                self.is_search_results_available_for_currently_active_image_url = True
+                self.print_output_or_format_string(session, f"\n Performing Reverse Image Search over the internet!")
+                yield ""
+                try:
+                    session.corpus = self.perform_reverse_image_search(image_url, image_hash=session.image_hash)
+                # no English Wikipedia page was found - the knowledge base is searched instead (below)
+                except No_Search_Results as e:
+                    logging.warning(f"Reverse image search failed: {e}")
+                    session.corpus = []
+                session.is_search_results_available_for_currently_active_image_url = True
 
             
             # 
             #### (Optional Step, Not Mandatory) from the question, come up with appropriate keywords for the contriever model to retrieve the relevant passages ####
             # 
             query = self.prompt_store["get_contriever_search_keywords"].format(question)
-            contriever_keywords = self.vlm.get_response(None, query)
-            self.print_output_or_format_string(f"\nSearching with the keywords : {contriever_keywords}")
+            with TRACER.span('vlm_call', prompt_type="get_contriever_search_keywords"):
+                contriever_keywords = self.vlm.get_response(None, query, **self.generation_store["get_contriever_search_keywords"])
+            self.print_output_or_format_string(session, f"\nSearching with the keywords : {contriever_keywords}")
+            yield ""
 
 
             # 
             #### get top-K contexts that might potentially support the given guery ####
             # 
             contriever_search_query = f"Question: {question} Keywords: {contriever_keywords}"
-            top_K_contexts = self.contriever.get_topK_contexts(query=contriever_search_query, K=10)
+            with TRACER.span('contriever_topK', num_passages=len(session.corpus)):
+                retriever = self.wait_for_retriever()
+                if len(session.corpus) > 0:
+                    top_K_contexts = retriever.get_topK_contexts(query=contriever_search_query, K=self.max_contexts, contexts=session.corpus)
+                else:
+                    # the reverse image search found no pages - search the passages of every page scraped so far (IVF index of the passage store)
+                    top_K_contexts = retriever.search_knowledge_base(contriever_search_query, K=self.max_contexts)
+            if len(session.corpus) == 0:
+                self.print_output_or_format_string(session, f"\nNo search results for this image, searched the {len(self.passage_store)} passages of the knowledge base instead")
+            top_K_contexts = top_K_contexts[:self.adaptive_K([relevance_score for context, relevance_score in top_K_contexts])]
 
 
             # store the agent_responses for individual contexts. finally aggregate them into one final answer!
             generated_answers_over_multiple_contexts = []
 
 
-            # for each of the top-10 contexts
-            for i, (context, relevance_score) in enumerate(top_K_contexts):
-                context = top_K_contexts[i][0]['content']
+            # 
+            #### group the contexts into packs that fit the token budget of one VLM call (or one context per call) ####
+            # 
+            if self.context_packer is None:
+                packs = [[(i, context)] for i, (context, relevance_score) in enumerate(top_K_contexts)]
+                contexts = [context['content'] for context, relevance_score in top_K_contexts]
+                prompt_type = "answer_with_context_prompt"
+            else:
+                packs = self.context_packer.pack([context for context, relevance_score in top_K_contexts])
+                contexts = [self.context_packer.format(pack) for pack in packs]
+                prompt_type = "answer_with_packed_contexts_prompt"
+
+
+            # 
+            #### instruct vlm to answer the query with each supporting context / pack of contexts (and self-check the answers) ####
+            # 
+            responses = self.process_contexts(session.image, contexts, question, deadline=deadline, target_verified_answers=self.target_verified_answers, prompt_type=prompt_type)
+
+            # for each of the packs (each of the top-K contexts without packing)
+            for pack, context, response in zip(packs, contexts, responses):
+                context_label = "Context " + ", ".join(str(rank + 1) for rank, packed_context in pack)
 
                 # 
-                #### instruct vlm to answer the query with the supporting context ####
+                # the turn stopped (deadline or enough verified answers) before this context was processed
                 # 
-                query = self.prompt_store["answer_with_context_prompt"].format(context, question)
-                agent_response = self.vlm.get_response(self.image, query)
+                if response is None:
+                    TRACER.increment('skipped_passages', len(pack), reason="budget")
+                    continue
+                answer_to_be_verified, agent_response = response
 
                 # 
                 # if currently provided context doesnot contain the relevant information, the model simply skips to the next context
                 # 
-                if "SKIP PASSAGE" in agent_response:
-                    self.print_output_or_format_string(f"\n[SKIP] Context {i+1} - {context[:50]} .... !")
+                if agent_response is None:
+                    TRACER.increment('skipped_passages', len(pack), reason="skip_passage")
+                    self.print_output_or_format_string(session, f"\n[SKIP] {context_label} - {context[:50]} .... !")
                     continue
 
                 # 
-                #### the model replies with an answer supported by the context ####
-                ## however, we still need to double check the answer. so, we instruct the model to check again if the answer is correctly supported by the context! ##
+                #### the model replied with an answer supported by the context ####
+                ## however, we still need to double check the answer. so, the model was instructed to check again if the answer is correctly supported by the context! ##
                 # 
                 else:
-                    answer_to_be_verified = agent_response
-                    query = self.prompt_store["self_check"].format(context, answer_to_be_verified)
-                    agent_response = self.vlm.get_response(self.image, query)  # model replies with "OK" or "NOT SUPPORTED" 
-
+                    # model replies with "OK" or "NOT SUPPORTED" 
                     if "OK" in agent_response:
-                        # just making the results easy to read
-                        self.print_output_or_format_string(f"\n*Answer* : {answer_to_be_verified}")
-                        self.print_output_or_format_string(f"\nSupported by Context {i+1} : {context}")
-                        self.print_output_or_format_string(f"\nReference - {top_K_contexts[i][0]['URL']}")
+                        TRACER.increment('verified_answers')
+                        generated_answers_over_multiple_contexts.append(answer_to_be_verified)
+                        # just making the results easy to read (a pack lists the passages cited by the answer)
+                        self.print_output_or_format_string(session, f"\n*Answer* : {answer_to_be_verified}")
+                        cited_passages = pack if self.context_packer is None else self.context_packer.cited_passages(answer_to_be_verified, pack)
+                        for rank, cited_context in cited_passages:
+                            self.print_output_or_format_string(session, f"\nSupported by Context {rank+1} : {cited_context['content']}")
+                            self.print_output_or_format_string(session, f"\nReference - {cited_context['URL']}")
 
                     elif "NOT SUPPORTED" in agent_response:
-                        self.print_output_or_format_string(f"\n[SKIP] Context {i+1} - {context[:50]} .... !")
+                        TRACER.increment('skipped_passages', len(pack), reason="not_supported")
+                        self.print_output_or_format_string(session, f"\n[SKIP] {context_label} - {context[:50]} .... !")
                         pass
                     
                     else:
-                        self.print_output_or_format_string("\n^^^^ Undesired Response ^^^^\n")
+                        self.print_output_or_format_string(session, "\n^^^^ Undesired Response ^^^^\n")
+                yield ""
+
+            num_unprocessed_contexts = sum(len(pack) for pack, response in zip(packs, responses) if response is None)
+            if num_unprocessed_contexts > 0:
+                self.print_output_or_format_string(session, f"\n[BUDGET] {num_unprocessed_contexts} of {len(top_K_contexts)} contexts were not processed (deadline / target number of verified answers reached)")
+                yield ""
             
             """
             #                           ######### aggregate all previous answers to one final answer #########
@@ -170,22 +427,13 @@ class vlm_rag_agent():
             aggregated_final_answer = self.vlm.get_response(None,query) # image not required for this step
 
             # just making the results easy to read
-            self.print_output_or_format_string("\n"+"="*100+"\n")
-            self.print_output_or_format_string(f"**\nFinal Answer** : {aggregated_final_answer}\n")
+            self.print_output_or_format_string(session, "\n"+"="*100+"\n")
+            self.print_output_or_format_string(session, f"**\nFinal Answer** : {aggregated_final_answer}\n")
             """
 
-            if self.gradio_demo:
-                gradio_string_copy = self.gradio_string
-                self.gradio_string = "" # reset after answering a query
-                return gradio_string_copy
-
 
         # 
         #### vlm is confident enough to answer directly (might still contain hallucinations...!!!) ####
         # 
         else:
-            self.print_output_or_format_string(f"\n*Direct Answer* : {agent_response}")
-            if self.gradio_demo:
-                gradio_string_copy = self.gradio_string
-                self.gradio_string = "" # reset after answering a query
-                return gradio_string_copy
\ No newline at end of file
+            self.print_output_or_format_string(session, f"\n*Direct Answer* : {agent_response}")
@@ -1,50 +1,433 @@
+import os
+import asyncio
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import httpx
 import base64
+import hashlib
+import weakref
+import threading
 from io import BytesIO
+from urllib.parse import urlparse
 
+from tracing import TRACER
+from replica_pool import Replica_Pool
+
+# server errors worth retrying (the request itself might succeed on a second attempt)
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+# comma-separated list of replicas of each VLM server, e.g. PHI3V_ENDPOINTS="http://gpu0:8001,http://gpu1:8001"
+ENDPOINT_ENV_VARS = {'mini_cpm_llama3v': "MINICPM_ENDPOINTS", 'phi3_vision': "PHI3V_ENDPOINTS"}
+
+# do_sample default of the /predict endpoint of each VLM server (used when the request does not set it), and whether
+# /predict_stream always samples - sampled responses must not be cached
+SAMPLING_DEFAULTS = {'mini_cpm_llama3v': {'do_sample': True, 'stream_samples': True},
+                     'phi3_vision': {'do_sample': False, 'stream_samples': False}}
+
+# errors after which the call is sent to another replica (the server is down, hung, or failing)
+def is_replica_failure(error):
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, httpx.TransportError)):
+        return True
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code in RETRY_STATUS_CODES
+
+"""
+Connection-pooled client for the VLM servers
+ - one persistent keep-alive session with at most `pool_size` sockets per server
+ - (connect_timeout, read_timeout) on every request, so a hung server cannot block the agent forever
+ - the model can be served by several replicas (`base_urls`, or the PHI3V_ENDPOINTS / MINICPM_ENDPOINTS environment
+   variables): each call is routed by the Replica_Pool (power-of-two-choices on outstanding requests, health checks)
+   and fails over to another replica on connection errors, timeouts and 5xx responses
+ - with a single server: up to `max_retries` retries with exponential backoff (`backoff_factor`) on 5xx responses and
+   connection errors (with several replicas failing over replaces retrying the same server). read timeouts are never
+   retried - the server may still be generating, retrying would only queue the same generation again
+ - (optional) `response_cache`: deterministic requests are answered from a Response_Cache (see response_cache.py)
+"""
 class My_VLM_APIs():
 
-    def __init__(self, model_name) -> None:
+    def __init__(self, model_name, pool_size=16, connect_timeout=3.0, read_timeout=120.0, max_retries=3, backoff_factor=0.5,
+                 base_url=None, base_urls=None, health_check_interval=5.0, response_cache=None) -> None:
 
         currently_available_apis = ['mini_cpm_llama3v','phi3_vision']
 
         # define the URL for the FastAPI servers
         # localhost defaults to 127.0.0.1
         if model_name == 'mini_cpm_llama3v':
-            self.server_url = 'http://localhost:8000/predict'
+            default_url = 'http://localhost:8000'
         elif model_name == 'phi3_vision':
-            self.server_url = 'http://localhost:8001/predict'
+            default_url = 'http://localhost:8001'
         else:
             print("\n API unavailable")
             print(f"\n Currently available APIs are {currently_available_apis}")
             exit()
+        self.model_name = model_name
+        # e.g. a server on another host (or the stub server of benchmarks/stub_vlm_server.py)
+        if base_urls is None:
+            endpoints = os.environ.get(ENDPOINT_ENV_VARS[model_name], "")
+            base_urls = [base_url] if base_url is not None else [url.strip() for url in endpoints.split(',') if url.strip()] or [default_url]
+        self.pool = Replica_Pool(base_urls, health_check_interval=health_check_interval)
+        self.base_url = self.pool.replicas[0].url
+        self.server_url = f'{self.base_url}/predict'
+
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries if len(self.pool) == 1 else 0
+        self.backoff_factor = backoff_factor
+        self.session = self.create_session(pool_size)
+
+        # images are uploaded once per replica via /register_image, afterwards only the returned handle is sent
+        # {id(PIL_image): (weakref to PIL_image, {replica_url: image_handle})}
+        self.image_handles = {}
+        self.image_handles_lock = threading.Lock()
+
+        # responses of deterministic requests, keyed by the content hash of the image (computed once per PIL image)
+        # {id(PIL_image): (weakref to PIL_image, image_hash)}
+        self.response_cache = response_cache
+        self.image_hashes = {}
+
+    def create_session(self, pool_size):
+        # read=0: a request that reached the server is only retried on a 5xx response, not after a read timeout
+        retries = Retry(total=self.max_retries, read=0, backoff_factor=self.backoff_factor, status_forcelist=RETRY_STATUS_CODES,
+                        allowed_methods=None, raise_on_status=False)
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries))
+        session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries))
+        return session
+
+    def post(self, url, payload):
+        endpoint = urlparse(url).path
+        TRACER.increment('vlm_requests', endpoint=endpoint)
+        with TRACER.span('http_post', endpoint=endpoint):
+            return self.session.post(url, json=payload, timeout=self.timeout)
 
     # you cannot send the image directly to the FastAPI server as a json - <TypeError: Object of type Image is not JSON serializable>
     # this snippet converts a PIL image to a string that can be sent via a json
+    # (the image is not closed - it is cached by the image loader and may be uploaded again after a 404)
     def  PIL_Image_to_base64_string(self, PIL_image):
-        with PIL_image as img:
-            # Create a BytesIO buffer and save the image data to it
-            with BytesIO() as buffer:
-                img.save(buffer, 'JPEG')
-                # Get the byte data from the buffer
-                byte_data = buffer.getvalue()
+        # Create a BytesIO buffer and save the image data to it
+        with BytesIO() as buffer:
+            PIL_image.save(buffer, 'JPEG')
+            # Get the byte data from the buffer
+            byte_data = buffer.getvalue()
         # Convert the byte data to a base64 string
         base64_str = base64.b64encode(byte_data).decode()
         return base64_str
     
-    # Function to send a request to FastAPI server and get response
-    def get_response(self, image, query):
+    # handle of an image that was already uploaded to the replica (None if it was never uploaded there)
+    def cached_image_handle(self, image, replica):
+        with self.image_handles_lock:
+            image_ref, handles = self.image_handles.get(id(image), (None, {}))
+            return handles.get(replica.url) if image_ref is not None and image_ref() is image else None
+
+    def store_image_handle(self, image, replica, handle):
+        with self.image_handles_lock:
+            # drop handles of images that no longer exist
+            self.image_handles = {key: value for key, value in self.image_handles.items() if value[0]() is not None}
+            image_ref, handles = self.image_handles.get(id(image), (None, {}))
+            if image_ref is None or image_ref() is not image:
+                handles = {}
+            self.image_handles[id(image)] = (weakref.ref(image), {**handles, replica.url: handle})
+
+    # content hash of the pixels of the image (None for requests without an image)
+    def image_content_hash(self, image):
+        if image is None:
+            return None
+        with self.image_handles_lock:
+            image_ref, image_hash = self.image_hashes.get(id(image), (None, None))
+            if image_ref is not None and image_ref() is image:
+                return image_hash
+        image_hash = hashlib.sha256(f"{image.mode}{image.size}".encode('utf-8') + image.tobytes()).hexdigest()
+        with self.image_handles_lock:
+            # drop hashes of images that no longer exist
+            self.image_hashes = {key: value for key, value in self.image_hashes.items() if value[0]() is not None}
+            self.image_hashes[id(image)] = (weakref.ref(image), image_hash)
+        return image_hash
+
+    # key of the request in the response cache, None if there is no cache or the request is not cacheable (sampling)
+    # (/predict and /predict_stream generate the same response, both are cached under /predict)
+    # the sampling default of the server is made explicit, e.g. MiniCPM samples unless do_sample=False is sent
+    def response_cache_key(self, endpoint, image, query, stream=False, **generation):
+        if self.response_cache is None:
+            return None
+        if endpoint == '/predict':
+            sampling_defaults = SAMPLING_DEFAULTS[self.model_name]
+            generation = {'do_sample': sampling_defaults['do_sample'], **generation}
+            if stream and sampling_defaults['stream_samples']:
+                generation['do_sample'] = True
+        return self.response_cache.key(self.model_name, endpoint, self.image_content_hash(image), query, **generation)
+
+    # upload the image to the replica (only once per PIL image and replica) and return its content-hash handle
+    def register_image(self, image, replica, force_upload=False):
+        handle = self.cached_image_handle(image, replica)
+        if handle is not None and not force_upload:
+            return handle
+
+        response = self.post(f'{replica.url}/register_image', {'str_image': self.PIL_Image_to_base64_string(image)})
+        response.raise_for_status()
+        handle = response.json()['image_handle']
+        self.store_image_handle(image, replica, handle)
+        return handle
+
+    # send the payload together with the image (as a handle) to the endpoint of one replica
+    def post_to_replica(self, replica, path, image, payload):
 
         if image == None:
-            image_as_string = 'No Image Provided'
+            response = self.post(f'{replica.url}{path}', {'str_image': 'No Image Provided', **payload})
         else:
-            image_as_string = self.PIL_Image_to_base64_string(image)
+            response = self.post(f'{replica.url}{path}', {'image_handle': self.register_image(image, replica), **payload})
+            # the server evicted the image from its store - upload it again and retry
+            if response.status_code == 404:
+                response = self.post(f'{replica.url}{path}', {'image_handle': self.register_image(image, replica, force_upload=True), **payload})
 
-        # send request to server
-        response = requests.post(self.server_url, json={'str_image': image_as_string, 'user_query': query})
         # Raise an error if the request was unsuccessful
         response.raise_for_status()
+        return response
+
+    # send the payload together with the image to the endpoint (path) of the least loaded replica, failing over to the
+    # other replicas if it is down or failing
+    def post_with_image(self, path, image, payload):
+        last_error = None
+        for replica in self.pool.failover_order():
+            try:
+                with self.pool.track(replica):
+                    response = self.post_to_replica(replica, path, image, payload)
+            except (requests.exceptions.RequestException, httpx.HTTPError) as error:
+                if not is_replica_failure(error):
+                    raise
+                self.pool.mark_failure(replica, repr(error))
+                TRACER.increment('vlm_failovers', endpoint=path)
+                last_error = error
+                continue
+            self.pool.mark_success(replica)
+            return response.json()
+        raise last_error
+
+    # Function to send a request to FastAPI server and get response
+    # generation = per-request generation controls understood by the server: max_new_tokens, stop (list of strings), do_sample, temperature, top_p
+    def get_response(self, image, query, **generation):
+
+        cache_key = self.response_cache_key('/predict', image, query, **generation)
+        cached_response = None if cache_key is None else self.response_cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response
 
         # return the response
-        output = response.json()
-        return output['vlm_response']
\ No newline at end of file
+        output = self.post_with_image('/predict', image, {'user_query': query, **generation})
+        if cache_key is not None:
+            self.response_cache.put(cache_key, output['vlm_response'])
+        return output['vlm_response']
+
+    # pick one of the labels (e.g. ["[OK]", "[NOT SUPPORTED]"]) as the response to the query, scored in a single forward pass
+    def classify(self, image, query, labels):
+        cache_key = self.response_cache_key('/classify', image, query, labels=labels)
+        cached_label = None if cache_key is None else self.response_cache.get(cache_key)
+        if cached_label is not None:
+            return cached_label
+
+        output = self.post_with_image('/classify', image, {'user_query': query, 'labels': labels})
+        if cache_key is not None:
+            self.response_cache.put(cache_key, output['label'])
+        return output['label']
+
+    # open a /predict_stream response on one replica (the body is not read yet)
+    def open_stream(self, replica, image, payload):
+
+        # the second attempt only happens if the server evicted the image from its store (re-upload and retry)
+        for force_upload in (False, True):
+            if image == None:
+                image_payload = {'str_image': 'No Image Provided'}
+            else:
+                image_payload = {'image_handle': self.register_image(image, replica, force_upload)}
+
+            TRACER.increment('vlm_requests', endpoint='/predict_stream')
+            response = self.session.post(f'{replica.url}/predict_stream', json={**image_payload, **payload}, timeout=self.timeout, stream=True)
+            if response.status_code == 404 and image != None and not force_upload:
+                response.close()
+                continue
+            if not response.ok:
+                response.close()
+            response.raise_for_status()
+            return response
+
+    # same as get_response, but yields the response text chunk by chunk as the server generates it (/predict_stream)
+    # (a stream is only failed over to another replica before its first chunk - the chunks already yielded cannot be taken back)
+    # (a cached response is yielded as a single chunk, a streamed response is cached once it is complete)
+    def stream_response(self, image, query, **generation):
+        cache_key = self.response_cache_key('/predict', image, query, stream=True, **generation)
+        cached_response = None if cache_key is None else self.response_cache.get(cache_key)
+        if cached_response is not None:
+            yield cached_response
+            return
+
+        last_error = None
+        for replica in self.pool.failover_order():
+            with self.pool.track(replica):
+                try:
+                    response = self.open_stream(replica, image, {'user_query': query, **generation})
+                except (requests.exceptions.RequestException, httpx.HTTPError) as error:
+                    if not is_replica_failure(error):
+                        raise
+                    self.pool.mark_failure(replica, repr(error))
+                    TRACER.increment('vlm_failovers', endpoint='/predict_stream')
+                    last_error = error
+                    continue
+                self.pool.mark_success(replica)
+                streamed_response = ""
+                with response:
+                    for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+                        streamed_response += chunk
+                        yield chunk
+                if cache_key is not None:
+                    self.response_cache.put(cache_key, streamed_response)
+                return
+        raise last_error
+
+
+"""
+asyncio-native client with the same contract as My_VLM_APIs (`await vlm.get_response(image, query)`)
+so that many VLM calls can be issued concurrently over a handful of sockets
+"""
+class My_Async_VLM_APIs(My_VLM_APIs):
+
+    def create_session(self, pool_size):
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        timeout = httpx.Timeout(self.timeout[1], connect=self.timeout[0])
+        return httpx.AsyncClient(limits=limits, timeout=timeout)
+
+    async def post(self, url, payload):
+        endpoint = urlparse(url).path
+        TRACER.increment('vlm_requests', endpoint=endpoint)
+        with TRACER.span('http_post', endpoint=endpoint):
+            return await self.post_with_retries(url, payload)
+
+    async def post_with_retries(self, url, payload):
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self.session.post(url, json=payload)
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                    return response
+            # only connection errors are retried (not read timeouts, see create_session)
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                if attempt == self.max_retries:
+                    raise
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+
+    async def register_image(self, image, replica, force_upload=False):
+        handle = self.cached_image_handle(image, replica)
+        if handle is not None and not force_upload:
+            return handle
+
+        response = await self.post(f'{replica.url}/register_image', {'str_image': self.PIL_Image_to_base64_string(image)})
+        response.raise_for_status()
+        handle = response.json()['image_handle']
+        self.store_image_handle(image, replica, handle)
+        return handle
+
+    async def post_to_replica(self, replica, path, image, payload):
+
+        if image == None:
+            response = await self.post(f'{replica.url}{path}', {'str_image': 'No Image Provided', **payload})
+        else:
+            response = await self.post(f'{replica.url}{path}', {'image_handle': await self.register_image(image, replica), **payload})
+            # the server evicted the image from its store - upload it again and retry
+            if response.status_code == 404:
+                response = await self.post(f'{replica.url}{path}', {'image_handle': await self.register_image(image, replica, force_upload=True), **payload})
+
+        # Raise an error if the request was unsuccessful
+        response.raise_for_status()
+        return response
+
+    async def post_with_image(self, path, image, payload):
+        last_error = None
+        for replica in self.pool.failover_order():
+            try:
+                with self.pool.track(replica):
+                    response = await self.post_to_replica(replica, path, image, payload)
+            except (requests.exceptions.RequestException, httpx.HTTPError) as error:
+                if not is_replica_failure(error):
+                    raise
+                self.pool.mark_failure(replica, repr(error))
+                TRACER.increment('vlm_failovers', endpoint=path)
+                last_error = error
+                continue
+            self.pool.mark_success(replica)
+            return response.json()
+        raise last_error
+
+    # the response cache (SQLite on-disk tier) is accessed in a worker thread, not to block the event loop
+    async def get_response(self, image, query, **generation):
+        cache_key = self.response_cache_key('/predict', image, query, **generation)
+        cached_response = None if cache_key is None else await asyncio.to_thread(self.response_cache.get, cache_key)
+        if cached_response is not None:
+            return cached_response
+
+        output = await self.post_with_image('/predict', image, {'user_query': query, **generation})
+        if cache_key is not None:
+            await asyncio.to_thread(self.response_cache.put, cache_key, output['vlm_response'])
+        return output['vlm_response']
+
+    async def classify(self, image, query, labels):
+        cache_key = self.response_cache_key('/classify', image, query, labels=labels)
+        cached_label = None if cache_key is None else await asyncio.to_thread(self.response_cache.get, cache_key)
+        if cached_label is not None:
+            return cached_label
+
+        output = await self.post_with_image('/classify', image, {'user_query': query, 'labels': labels})
+        if cache_key is not None:
+            await asyncio.to_thread(self.response_cache.put, cache_key, output['label'])
+        return output['label']
+
+    async def open_stream(self, replica, image, payload):
+
+        # the second attempt only happens if the server evicted the image from its store (re-upload and retry)
+        for force_upload in (False, True):
+            if image == None:
+                image_payload = {'str_image': 'No Image Provided'}
+            else:
+                image_payload = {'image_handle': await self.register_image(image, replica, force_upload)}
+
+            TRACER.increment('vlm_requests', endpoint='/predict_stream')
+            request = self.session.build_request('POST', f'{replica.url}/predict_stream', json={**image_payload, **payload})
+            response = await self.session.send(request, stream=True)
+            if response.status_code == 404 and image != None and not force_upload:
+                await response.aclose()
+                continue
+            if not response.is_success:
+                await response.aclose()
+            response.raise_for_status()
+            return response
+
+    async def stream_response(self, image, query, **generation):
+        cache_key = self.response_cache_key('/predict', image, query, stream=True, **generation)
+        cached_response = None if cache_key is None else await asyncio.to_thread(self.response_cache.get, cache_key)
+        if cached_response is not None:
+            yield cached_response
+            return
+
+        last_error = None
+        for replica in self.pool.failover_order():
+            with self.pool.track(replica):
+                try:
+                    response = await self.open_stream(replica, image, {'user_query': query, **generation})
+                except (requests.exceptions.RequestException, httpx.HTTPError) as error:
+                    if not is_replica_failure(error):
+                        raise
+                    self.pool.mark_failure(replica, repr(error))
+                    TRACER.increment('vlm_failovers', endpoint='/predict_stream')
+                    last_error = error
+                    continue
+                self.pool.mark_success(replica)
+                streamed_response = ""
+                try:
+                    async for chunk in response.aiter_text():
+                        streamed_response += chunk
+                        yield chunk
+                finally:
+                    await response.aclose()
+                if cache_key is not None:
+                    await asyncio.to_thread(self.response_cache.put, cache_key, streamed_response)
+                return
+        raise last_error
+
+    async def close(self):
+        await self.session.aclose()
@@ -0,0 +1,133 @@
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import defaultdict, deque
+
+"""
+                                Per-stage Tracing and Counters for the Agent
+
+Every chat turn is traced as a tree of timed spans, e.g.
+    chat_turn > reverse_image_search > search_tool_1 / fetch_webpage > parse_webpage
+              > contriever_topK > bm25_prefilter / sent_tokenize / contriever_encode
+              > vlm_call (prompt_type, context_index) > http_post
+The current span is held in a context variable, so spans opened in threads started through `TRACER.wrap(fn)` are attached
+to the span that was current when `wrap` was called.
+ - a finished turn is logged as one structured (json) record on the `phi3v_agent.trace` logger and kept in `last_traces`
+ - span durations (sum / count per span name) and counters (cache hits, VLM calls, skipped passages, ...) are
+   aggregated and can be exported with `prometheus_text()`
+"""
+logger = logging.getLogger('phi3v_agent.trace')
+
+class Span():
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.children = []
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'duration_ms': round(1000 * self.duration, 2) if self.duration is not None else None,
+            **({'attributes': self.attributes} if self.attributes else {}),
+            **({'children': [child.to_dict() for child in self.children]} if self.children else {}),
+        }
+
+
+class Tracer():
+    def __init__(self, namespace='phi3v_agent', max_traces=32):
+        self.namespace = namespace
+        self.current_span = contextvars.ContextVar('current_span', default=None)
+        self.last_traces = deque(maxlen=max_traces)
+
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float) # {(name, labels): value}
+        self.span_seconds = defaultdict(lambda: [0.0, 0]) # {span name: [sum of durations, count]}
+
+    @contextmanager
+    def span(self, name, **attributes):
+        parent = self.current_span.get()
+        span = Span(name, parent, attributes)
+        if parent is not None:
+            parent.children.append(span)
+        # set (instead of reset with a token) so that a generator resumed in another context can still close its span
+        self.current_span.set(span)
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - span.start
+            self.current_span.set(parent)
+            with self.lock:
+                self.span_seconds[name][0] += span.duration
+                self.span_seconds[name][1] += 1
+            if parent is None:
+                self.last_traces.append(span)
+                logger.info(json.dumps(span.to_dict()))
+
+    # attributes known only once the span is running (e.g. the number of passages found)
+    def set_attributes(self, **attributes):
+        span = self.current_span.get()
+        if span is not None:
+            span.attributes.update(attributes)
+
+    def increment(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    # returns fn running (optionally inside a span `name`) as a child of the span that is current now - for thread pools
+    def wrap(self, fn, name=None, **attributes):
+        parent = self.current_span.get()
+        def run(*args, **kwargs):
+            self.current_span.set(parent)
+            if name is None:
+                return fn(*args, **kwargs)
+            with self.span(name, **attributes):
+                return fn(*args, **kwargs)
+        # a fresh copy of the context per call, so the wrapped function can run in several threads at once
+        return lambda *args, **kwargs: contextvars.copy_context().run(run, *args, **kwargs)
+
+    # iterate a generator with every step running in the same context (gradio may resume a generator from different threads)
+    def iterate(self, generator):
+        context = contextvars.copy_context()
+        while True:
+            try:
+                item = context.run(next, generator)
+            except StopIteration:
+                return
+            yield item
+
+    def stats(self):
+        with self.lock:
+            return {
+                'counters': {name + ''.join(f'[{key}={value}]' for key, value in labels): value for (name, labels), value in self.counters.items()},
+                'spans': {name: {'total_s': round(total, 3), 'count': count} for name, (total, count) in self.span_seconds.items()},
+            }
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, labels in self.counters}):
+                lines.append(f"# TYPE {self.namespace}_{name}_total counter")
+                for (counter_name, labels), value in self.counters.items():
+                    if counter_name == name:
+                        lines.append(f"{self.namespace}_{name}_total{format_labels(labels)} {value}")
+            lines.append(f"# TYPE {self.namespace}_span_seconds summary")
+            for name, (total, count) in sorted(self.span_seconds.items()):
+                lines.append(f'{self.namespace}_span_seconds_sum{{span="{name}"}} {total}')
+                lines.append(f'{self.namespace}_span_seconds_count{{span="{name}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+# shared by the agent, scraper, retriever and VLM client
+TRACER = Tracer()
@@ -1,16 +1,108 @@
+import os
+import time
+import logging
+from threading import Thread, Event, Lock, local
+from contextlib import contextmanager, asynccontextmanager
 from PIL import Image
 import base64
 from io import BytesIO
 
-from fastapi import FastAPI, HTTPException
+from typing import Optional
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 
 import torch
 from transformers import AutoModel, AutoTokenizer
 
+from image_store import Image_Store
+from server_metrics import Server_Metrics, Generation_Timer
+
+
+"""
+MiniCPM-Llama3-V 2.5
+The weights are loaded in a background thread when the server starts, so the server answers health checks right away.
+/health reports whether the model is ready, /ready returns 503 until it is (and the inference endpoints return 503 as well,
+which the client retries)
+"""
+model_id = 'openbmb/MiniCPM-Llama3-V-2_5'
+model = None
+tokenizer = None
+model_ready = Event()
+model_load_error = None
+model_load_time = None
+
+"""
+model.chat drops logits processors, so the first-token time of /predict is marked by a forward hook on the language model:
+its first forward pass of a generation is the prefill. The timer of the generation running in the current thread is kept
+in a thread local (model.chat runs generate in the calling thread, except with stream=True, see /predict_stream)
+"""
+active_generation = local()
+
+def mark_prefill_done(module, inputs, outputs):
+    timer = getattr(active_generation, 'timer', None)
+    if timer is not None and timer.first_token_time is None:
+        torch.cuda.synchronize()
+        timer.mark_first_token()
+
+def load_model():
+    global model, tokenizer, model_load_error, model_load_time
+    start_time = time.perf_counter()
+    try:
+        # Load the model and tokenizer
+        loaded_model = AutoModel.from_pretrained(model_id, trust_remote_code=True, torch_dtype=torch.float16)
+        loaded_model = loaded_model.to(device='cuda')
+        loaded_model.eval()
+        loaded_model.llm.register_forward_hook(mark_prefill_done)
+        tokenizer = AutoTokenizer.from_pretrained(model_id, trust_remote_code=True)
+        model = loaded_model
+        model_load_time = time.perf_counter() - start_time
+    except Exception as e:
+        model_load_error = e
+        logging.error(f"Failed to load {model_id}: {e}")
+    finally:
+        model_ready.set()
+
+def require_model():
+    if model_load_error is not None:
+        raise HTTPException(status_code=500, detail=f"Model failed to load: {model_load_error}")
+    if not model_ready.is_set():
+        raise HTTPException(status_code=503, detail="Model is loading")
+
+@asynccontextmanager
+async def lifespan(app):
+    Thread(target=load_model, daemon=True).start()
+    yield
 
 # Define the FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# request counts / latencies, prefill & decode times and token counts (see /metrics)
+metrics = Server_Metrics(namespace='minicpm_server')
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start_time = time.perf_counter()
+    response = await call_next(request)
+    # for /predict_stream this is the time to the first byte of the response
+    metrics.observe('request_seconds', time.perf_counter() - start_time, endpoint=request.url.path)
+    metrics.increment('requests', endpoint=request.url.path, status=response.status_code)
+    return response
+
+# number of generations running (or waiting for the GPU) - exported as the `in_flight_generations` gauge
+in_flight_generations = 0
+in_flight_lock = Lock()
+
+@contextmanager
+def track_in_flight():
+    global in_flight_generations
+    with in_flight_lock:
+        in_flight_generations += 1
+    try:
+        yield
+    finally:
+        with in_flight_lock:
+            in_flight_generations -= 1
 
 # converts string to PIL.Image object
 def base64_string_to_PIL_Image(base64_str):
@@ -22,54 +114,154 @@ Pydantic is the most widely used data validation library for Python.
 FastAPI cannot work without Pydantic
 """
 # Define a request model
+# the image is either sent as a base64 string or as a handle returned by /register_image
 class ImageTextRequest(BaseModel):
-    str_image: str
+    str_image: str = 'No Image Provided'
+    image_handle: Optional[str] = None
     user_query: str
+    # per-request generation controls (defaults = MiniCPM's own defaults used so far)
+    max_new_tokens: Optional[int] = None
+    do_sample: bool = True # if sampling=False, beam_search will be used by default
+    temperature: float = 0.1
+    top_p: Optional[float] = None
 
 # Define a response model
 class TextResponse(BaseModel):
     vlm_response: str
 
-"""
-MiniCPM-Llama3-V 2.5
-"""
-# Load the model and tokenizer
-model = AutoModel.from_pretrained('openbmb/MiniCPM-Llama3-V-2_5', trust_remote_code=True, torch_dtype=torch.float16)
-model = model.to(device='cuda')
-tokenizer = AutoTokenizer.from_pretrained('openbmb/MiniCPM-Llama3-V-2_5', trust_remote_code=True)
-model.eval()
+class ImageRequest(BaseModel):
+    str_image: str
+
+class ImageHandleResponse(BaseModel):
+    image_handle: str
+
+# registered images are stored already decoded (RGB PIL images)
+image_store = Image_Store(max_images=int(os.environ.get("MINICPM_MAX_STORED_IMAGES", 64)))
 
 
 """
 FastAPI server for MiniCPM-Llama3-V 2.5
 """
+# Endpoint to upload an image once and get a handle that can be used in subsequent /predict calls
+@app.post('/register_image', response_model=ImageHandleResponse)
+def register_image(request: ImageRequest):
+    try:
+        handle = Image_Store.image_handle(base64.b64decode(request.str_image))
+        if image_store.get(handle) is None:
+            image_store.put(handle, base64_string_to_PIL_Image(request.str_image).convert('RGB'))
+        return ImageHandleResponse(image_handle=handle)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# image of a request - either from the image store (image_handle) or decoded from the base64 string
+def get_image(request):
+    if request.image_handle is not None:
+        image = image_store.get(request.image_handle)
+        # the image was evicted (or never registered) - the client has to upload it again
+        if image is None:
+            raise HTTPException(status_code=404, detail=f"Unknown image handle {request.image_handle}")
+        return image
+    assert request.str_image != 'No Image Provided', "MiniCPM-Llama3-V always expects an image as input"
+    return base64_string_to_PIL_Image(request.str_image)
+
+# extra keyword arguments of model.chat (passed on to generate)
+def generation_kwargs(request):
+    kwargs = {'sampling': request.do_sample}
+    if request.do_sample:
+        kwargs['temperature'] = request.temperature
+        if request.top_p is not None:
+            kwargs['top_p'] = request.top_p
+    if request.max_new_tokens is not None:
+        kwargs['max_new_tokens'] = request.max_new_tokens
+    return kwargs
+
 # Endpoint to process text and return the model's prediction
 @app.post('/predict', response_model=TextResponse)
 def predict(request: ImageTextRequest):
+    require_model()
     try:
 
-        assert request.str_image != 'No Image Provided', "MiniCPM-Llama3-V always expects an image as input"
-        image = base64_string_to_PIL_Image(request.str_image)
+        image = get_image(request)
         question = request.user_query
         message = [{'role': 'user', 'content': question}]
 
         
         # Get the model's predictions
-        with torch.no_grad():
-            mini_cpm_output = model.chat(
-                    image=image,
-                    msgs=message,
-                    tokenizer=tokenizer,
-                    sampling=True, # if sampling=False, beam_search will be used by default
-                    temperature=0.1,
-                    # system_prompt='' # pass system_prompt if needed
-                )
+        # (the prefill / decode split is marked by the forward hook of the language model, see mark_prefill_done)
+        timer = Generation_Timer()
+        active_generation.timer = timer
+        try:
+            with track_in_flight(), torch.no_grad():
+                mini_cpm_output = model.chat(
+                        image=image,
+                        msgs=message,
+                        tokenizer=tokenizer,
+                        **generation_kwargs(request),
+                        # system_prompt='' # pass system_prompt if needed
+                    )
+        finally:
+            active_generation.timer = None
+        metrics.record_generation('/predict', timer, len(tokenizer(mini_cpm_output, add_special_tokens=False)['input_ids']))
         return TextResponse(vlm_response=mini_cpm_output)
     
+    except HTTPException:
+        raise
     # this makes sure that the error message (if any) is sent to the client via API
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Endpoint to stream the model's prediction (plain text chunks) as the tokens are generated
+@app.post('/predict_stream')
+def predict_stream(request: ImageTextRequest):
+    require_model()
+    try:
+        image = get_image(request)
+        message = [{'role': 'user', 'content': request.user_query}]
+
+        # with stream=True, model.chat returns a generator of text chunks (streaming requires sampling=True)
+        # the prefill time is the time to the first chunk (model.chat drops logits processors, the timer is marked by hand)
+        def mini_cpm_stream():
+            timer = Generation_Timer()
+            mini_cpm_output = ""
+            with track_in_flight(), torch.no_grad():
+                for chunk in model.chat(
+                        image=image,
+                        msgs=message,
+                        tokenizer=tokenizer,
+                        **dict(generation_kwargs(request), sampling=True, temperature=request.temperature),
+                        stream=True,
+                    ):
+                    timer.mark_first_token()
+                    mini_cpm_output += chunk
+                    yield chunk
+            metrics.record_generation('/predict_stream', timer, len(tokenizer(mini_cpm_output, add_special_tokens=False)['input_ids']))
+        return StreamingResponse(mini_cpm_stream(), media_type="text/plain")
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# liveness: the server is up (also while the model is loading)
+@app.get('/health')
+def health():
+    status = 'error' if model_load_error is not None else ('ready' if model_ready.is_set() else 'loading')
+    return {'status': status, 'model_id': model_id, 'model_load_time_s': model_load_time}
+
+# readiness: 200 once the model is loaded, 503 before
+@app.get('/ready')
+def ready():
+    require_model()
+    return {'status': 'ready'}
+
+# Endpoint for Prometheus (text exposition format), `/metrics?format=json` returns the same values as json
+@app.get('/metrics')
+def server_metrics(format: str = 'prometheus'):
+    gauges = {'in_flight_generations': in_flight_generations, 'stored_images': len(image_store)}
+    if format == 'json':
+        return {**metrics.stats(), **gauges}
+    return PlainTextResponse(metrics.prometheus_text(gauges), media_type='text/plain; version=0.0.4')
+
 """
 To run the server, `uvicorn MiniCPM_Llama3V_Server:app --host 127.0.0.1 --port 8000`
 """
\ No newline at end of file
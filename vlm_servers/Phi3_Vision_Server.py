@@ -1,16 +1,81 @@
+import os
+import time
+import logging
+from contextlib import asynccontextmanager
 from PIL import Image
 import base64
 from io import BytesIO
 
-from fastapi import FastAPI, HTTPException
+from typing import Optional, List, Dict
+from threading import Thread, Event
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 
 import torch
-from transformers import AutoModelForCausalLM, AutoProcessor
+from transformers import AutoModelForCausalLM, AutoProcessor, TextIteratorStreamer, LogitsProcessorList
 
+from request_batcher import Request_Batcher
+from image_store import Image_Store
+from prefix_cache import Prefix_KV_Cache, generate_with_prefix_cache, generate_batch_with_prefix_cache, kv_bytes_per_token
+from server_metrics import Server_Metrics, Generation_Timer
+
+
+"""
+Phi3 Vision Model
+The weights are loaded in a background thread when the server starts, so the server answers health checks right away.
+/health reports whether the model is ready, /ready returns 503 until it is (and the inference endpoints return 503 as well,
+which the client retries)
+"""
+device = torch.device("cuda:2")
+model_id = "microsoft/Phi-3-vision-128k-instruct"
+model = None
+processor = None
+model_ready = Event()
+model_load_error = None
+model_load_time = None
+
+def load_model():
+    global model, processor, model_load_error, model_load_time
+    start_time = time.perf_counter()
+    try:
+        loaded_model = AutoModelForCausalLM.from_pretrained(model_id, trust_remote_code=True, torch_dtype="auto", _attn_implementation='flash_attention_2').to(device)
+        loaded_model.eval()
+        configure_prefix_cache(loaded_model)
+        processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
+        model = loaded_model
+        model_load_time = time.perf_counter() - start_time
+    except Exception as e:
+        model_load_error = e
+        logging.error(f"Failed to load {model_id}: {e}")
+    finally:
+        model_ready.set()
+
+def require_model():
+    if model_load_error is not None:
+        raise HTTPException(status_code=500, detail=f"Model failed to load: {model_load_error}")
+    if not model_ready.is_set():
+        raise HTTPException(status_code=503, detail="Model is loading")
+
+@asynccontextmanager
+async def lifespan(app):
+    Thread(target=load_model, daemon=True).start()
+    yield
 
 # Define the FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# request counts / latencies, prefill & decode times and token counts (see /metrics)
+metrics = Server_Metrics(namespace='phi3v_server')
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start_time = time.perf_counter()
+    response = await call_next(request)
+    # for /predict_stream this is the time to the first byte of the response
+    metrics.observe('request_seconds', time.perf_counter() - start_time, endpoint=request.url.path)
+    metrics.increment('requests', endpoint=request.url.path, status=response.status_code)
+    return response
 
 # converts string to PIL.Image object
 def base64_string_to_PIL_Image(base64_str):
@@ -22,58 +87,325 @@ Pydantic is the most widely used data validation library for Python.
 FastAPI cannot work without Pydantic
 """
 # Define a request model
+# the image is either sent as a base64 string or as a handle returned by /register_image
 class ImageTextRequest(BaseModel):
-    str_image: str
+    str_image: str = 'No Image Provided'
+    image_handle: Optional[str] = None
     user_query: str
+    # per-request generation controls (greedy decoding of at most 200 tokens by default)
+    max_new_tokens: int = 200
+    stop: Optional[List[str]] = None # generation stops as soon as one of these strings is generated
+    do_sample: bool = False
+    temperature: float = 1.0
+    top_p: float = 1.0
 
 # Define a response model
 class TextResponse(BaseModel):
     vlm_response: str
 
+class ImageRequest(BaseModel):
+    str_image: str
+
+class ImageHandleResponse(BaseModel):
+    image_handle: str
+
+# the labels are scored by their log-likelihood as a response to the user_query
+class ClassifyRequest(BaseModel):
+    str_image: str = 'No Image Provided'
+    image_handle: Optional[str] = None
+    user_query: str
+    labels: List[str]
+
+class ClassifyResponse(BaseModel):
+    label: str
+    scores: Dict[str, float]
+
 """
-Phi3 Vision Model
+Batched generation
+ - each request is processed (prompt template + image crops) individually and left padded to the longest prompt in the batch
+ - requests with and without an image are generated in separate sub-batches
 """
-device = torch.device("cuda:2")
-model_id = "microsoft/Phi-3-vision-128k-instruct"
-model = AutoModelForCausalLM.from_pretrained(model_id, trust_remote_code=True, torch_dtype="auto", _attn_implementation='flash_attention_2').to(device)
-model.eval()
-processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
+MAX_BATCH_SIZE = int(os.environ.get("PHI3V_MAX_BATCH_SIZE", 8))
+MAX_WAIT_MS = float(os.environ.get("PHI3V_MAX_WAIT_MS", 10))
+
+# registered images are stored already preprocessed (pixel values of all crops + image sizes)
+image_store = Image_Store(max_images=int(os.environ.get("PHI3V_MAX_STORED_IMAGES", 64)))
+
+def preprocess_image(input_image):
+    return processor.image_processor([input_image], return_tensors="pt")
+
+def prepare_inputs(image_inputs, user_prompt):
+    # convert the user prompt to phi3v prompt format and tokenize them
+    messages = [{"role": "user", "content": f"<|image_1|>\n{user_prompt}"}]
+    prompt = processor.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+    if image_inputs == None:
+        return processor(prompt, images=None, return_tensors="pt")
+    else:
+        # same as processor(prompt, [input_image]) but reusing the already preprocessed image
+        return processor._convert_images_texts_to_inputs(image_inputs, prompt, return_tensors="pt")
+
+# generation settings of a request as a hashable tuple (requests are only batched with requests using the same settings)
+def generation_settings(request):
+    return (request.max_new_tokens, request.do_sample, request.temperature, request.top_p, tuple(request.stop or ()))
+
+def generation_kwargs(generation):
+    max_new_tokens, do_sample, temperature, top_p, stop = generation
+    kwargs = {'max_new_tokens': max_new_tokens, 'do_sample': do_sample, 'eos_token_id': processor.tokenizer.eos_token_id}
+    if do_sample:
+        kwargs.update(temperature=temperature, top_p=top_p)
+    if len(stop) > 0:
+        kwargs.update(stop_strings=list(stop), tokenizer=processor.tokenizer)
+    return kwargs
+
+def generate_batch(batch_inputs, generation):
+    pad_token_id = processor.tokenizer.pad_token_id if processor.tokenizer.pad_token_id is not None else processor.tokenizer.eos_token_id
+    max_length = max(inputs['input_ids'].shape[1] for inputs in batch_inputs)
+
+    input_ids, attention_mask = [], []
+    for inputs in batch_inputs:
+        num_pad = max_length - inputs['input_ids'].shape[1]
+        input_ids.append(torch.nn.functional.pad(inputs['input_ids'], (num_pad, 0), value=pad_token_id))
+        attention_mask.append(torch.nn.functional.pad(inputs['attention_mask'], (num_pad, 0), value=0))
+    batch = {'input_ids': torch.cat(input_ids), 'attention_mask': torch.cat(attention_mask)}
+    if 'pixel_values' in batch_inputs[0]:
+        batch['pixel_values'] = torch.cat([inputs['pixel_values'] for inputs in batch_inputs])
+        batch['image_sizes'] = torch.cat([inputs['image_sizes'] for inputs in batch_inputs])
+    batch = {key: value.to(device) for key, value in batch.items()}
+
+    # generate response
+    timer = Generation_Timer()
+    with torch.no_grad():
+        generate_ids = model.generate(**batch, pad_token_id=pad_token_id, logits_processor=LogitsProcessorList([timer]), **generation_kwargs(generation))
+        generate_ids = generate_ids[:, max_length:] # remove input tokens
+    metrics.record_generation('/predict', timer, int((generate_ids != pad_token_id).sum()), int(batch['attention_mask'].sum()), batch_size=len(batch_inputs))
+    return processor.batch_decode(generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+
+"""
+Prompt-prefix KV caching (see prefix_cache.py)
+ - requests are grouped by image: a request generated on its own reuses the KV cache of the longest prompt prefix already
+   prefilled for the same image, so its prefill (and vision encoder) cost is proportional to the new suffix only
+ - a batch of requests for the same image (the concurrent fan-out of the agent, max_in_flight > 1) prefills the prefix
+   shared by its prompts once, from the cache, and generates the suffixes as one batch on top of it
+ - with PHI3V_PREFIX_CACHE_ENTRIES=0 the cache is off and requests with different images are batched together
+ - the cache is bounded in bytes of GPU memory: PHI3V_PREFIX_CACHE_MB, or by default PREFIX_CACHE_FREE_MEMORY_FRACTION of
+   the GPU memory still free once the model is loaded (~393 KB of KV cache per token for Phi-3-vision in bf16)
+"""
+PREFIX_CACHE_MAX_ENTRIES = int(os.environ.get("PHI3V_PREFIX_CACHE_ENTRIES", 32))
+PREFIX_CACHE_MAX_MB = os.environ.get("PHI3V_PREFIX_CACHE_MB")
+PREFIX_CACHE_FREE_MEMORY_FRACTION = 0.25
+prefix_cache = Prefix_KV_Cache(max_entries=PREFIX_CACHE_MAX_ENTRIES, max_bytes=0) # the budget is set once the model is loaded
+
+def configure_prefix_cache(loaded_model):
+    if PREFIX_CACHE_MAX_MB is not None:
+        prefix_cache.max_bytes = int(float(PREFIX_CACHE_MAX_MB) * 1024 ** 2)
+    else:
+        free_bytes, total_bytes = torch.cuda.mem_get_info(device)
+        prefix_cache.max_bytes = int(PREFIX_CACHE_FREE_MEMORY_FRACTION * free_bytes)
+    bytes_per_token = kv_bytes_per_token(loaded_model.config, loaded_model.dtype)
+    logging.info(f"Prefix KV cache budget: {prefix_cache.max_bytes / 1024 ** 3:.2f} GiB (~{prefix_cache.max_bytes // bytes_per_token} tokens of {bytes_per_token / 1024:.0f} KB)")
+
+def generate_same_image(image_key, batch_inputs, generation):
+    model_inputs = {key: batch_inputs[0][key].to(device) for key in ('pixel_values', 'image_sizes') if key in batch_inputs[0]}
+    pad_token_id = processor.tokenizer.pad_token_id if processor.tokenizer.pad_token_id is not None else processor.tokenizer.eos_token_id
+    # the prefill time includes the (partial) prefill of the shared prompt prefix done by generate_batch_with_prefix_cache
+    timer = Generation_Timer()
+    generate_ids = generate_batch_with_prefix_cache(model, prefix_cache, image_key, [inputs['input_ids'].to(device) for inputs in batch_inputs], pad_token_id,
+                                                    model_inputs, logits_processor=LogitsProcessorList([timer]), **generation_kwargs(generation))
+    metrics.record_generation('/predict', timer, int((generate_ids != pad_token_id).sum()), sum(inputs['input_ids'].shape[1] for inputs in batch_inputs),
+                              batch_size=len(batch_inputs))
+    return processor.batch_decode(generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+
+def generate_single(image_key, inputs, generation):
+    model_inputs = {key: inputs[key].to(device) for key in ('pixel_values', 'image_sizes') if key in inputs}
+    # the prefill time includes the (partial) prefill of the prompt prefix done by generate_with_prefix_cache
+    timer = Generation_Timer()
+    generate_ids = generate_with_prefix_cache(model, prefix_cache, image_key, inputs['input_ids'].to(device), model_inputs,
+                                              logits_processor=LogitsProcessorList([timer]), **generation_kwargs(generation))
+    metrics.record_generation('/predict', timer, generate_ids.shape[1], inputs['input_ids'].shape[1])
+    return processor.batch_decode(generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)[0]
+
+# batch = [(image_key, inputs, generation), ...]
+# sub-batches are formed by (with / without image, generation settings), and by image when the prefix cache is on
+def run_batch(batch):
+    responses = [None] * len(batch)
+    sub_batches = {}
+    for i, (image_key, inputs, generation) in enumerate(batch):
+        sub_batches.setdefault(('pixel_values' in inputs, generation, image_key if PREFIX_CACHE_MAX_ENTRIES > 0 else None), []).append(i)
+    for (has_image, generation, image_key), ids in sub_batches.items():
+        if PREFIX_CACHE_MAX_ENTRIES > 0 and len(ids) == 1:
+            responses[ids[0]] = generate_single(*batch[ids[0]])
+        elif PREFIX_CACHE_MAX_ENTRIES > 0:
+            for i, response in zip(ids, generate_same_image(image_key, [batch[i][1] for i in ids], generation)):
+                responses[i] = response
+        else:
+            for i, response in zip(ids, generate_batch([batch[i][1] for i in ids], generation)):
+                responses[i] = response
+    return responses
+
+batcher = Request_Batcher(run_batch, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS)
 
 
 """
 FastAPI server for Phi3 Vision
 """
+# Endpoint to upload an image once and get a handle that can be used in subsequent /predict calls
+@app.post('/register_image', response_model=ImageHandleResponse)
+def register_image(request: ImageRequest):
+    require_model()
+    try:
+        handle = Image_Store.image_handle(base64.b64decode(request.str_image))
+        if image_store.get(handle) is None:
+            image_store.put(handle, preprocess_image(base64_string_to_PIL_Image(request.str_image)))
+        return ImageHandleResponse(image_handle=handle)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# preprocessed image of a request - either from the image store (image_handle) or decoded from the base64 string
+# returns (image_key, image_inputs), the image key (content hash) namespaces the prefix cache
+def get_image_inputs(request):
+    if request.image_handle is not None:
+        image_inputs = image_store.get(request.image_handle)
+        # the image was evicted (or never registered) - the client has to upload it again
+        if image_inputs is None:
+            raise HTTPException(status_code=404, detail=f"Unknown image handle {request.image_handle}")
+        return request.image_handle, image_inputs
+    elif request.str_image == 'No Image Provided':
+        return 'No Image Provided', None
+    else:
+        return Image_Store.image_handle(base64.b64decode(request.str_image)), preprocess_image(base64_string_to_PIL_Image(request.str_image))
+
 # Endpoint to process text and return the model's prediction
 @app.post('/predict', response_model=TextResponse)
 def predict(request: ImageTextRequest):
+    require_model()
     try:
 
-        if request.str_image == 'No Image Provided':
-            input_image = None
-        else:
-            input_image = base64_string_to_PIL_Image(request.str_image)
-        user_prompt = request.user_query
-
-        # convert the user prompt to phi3v prompt format and tokenize them
-        messages = [{"role": "user", "content": f"<|image_1|>\n{user_prompt}"}]
-        prompt = processor.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        image_key, image_inputs = get_image_inputs(request)
 
-        if input_image == None:
-            inputs = processor(prompt, images=None, return_tensors="pt").to(device)
-        else:
-            inputs = processor(prompt, [input_image], return_tensors="pt").to(device)
-
-        # generate response
-        with torch.no_grad():
-            generate_ids = model.generate(**inputs, max_new_tokens=200, eos_token_id=processor.tokenizer.eos_token_id)
-            generate_ids = generate_ids[:, inputs['input_ids'].shape[1]:] # remove input tokens
-            response = processor.batch_decode(generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)[0]
+        # the request is queued and generated together with other concurrent requests
+        response = batcher.submit((image_key, prepare_inputs(image_inputs, request.user_query), generation_settings(request)))
         return TextResponse(vlm_response=response)
     
+    except HTTPException:
+        raise
     # this makes sure that the error message (if any) is sent to the client via API
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# seconds to wait for the next streamed token before the response is closed
+STREAM_TOKEN_TIMEOUT = float(os.environ.get("PHI3V_STREAM_TOKEN_TIMEOUT", 120))
+
+# Endpoint to stream the model's prediction (plain text chunks) as the tokens are generated
+# streamed requests are not batched, the generation runs in its own thread and feeds a text streamer
+@app.post('/predict_stream')
+def predict_stream(request: ImageTextRequest):
+    require_model()
+    try:
+        image_key, image_inputs = get_image_inputs(request)
+        inputs = prepare_inputs(image_inputs, request.user_query).to(device)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    # the timeout stops the response (instead of blocking its worker thread forever) if the generation thread stalls
+    streamer = TextIteratorStreamer(processor.tokenizer, skip_prompt=True, skip_special_tokens=True, clean_up_tokenization_spaces=False,
+                                    timeout=STREAM_TOKEN_TIMEOUT)
+
+    def generate():
+        timer = Generation_Timer()
+        try:
+            with torch.no_grad():
+                generate_ids = model.generate(**inputs, streamer=streamer, logits_processor=LogitsProcessorList([timer]), **generation_kwargs(generation_settings(request)))
+            metrics.record_generation('/predict_stream', timer, generate_ids.shape[1] - inputs['input_ids'].shape[1], inputs['input_ids'].shape[1])
+        except Exception as e:
+            metrics.increment('stream_errors')
+            logging.error(f"Streamed generation failed: {e}")
+        finally:
+            # ends the response even if the generation failed (the streamer is not ended by model.generate then)
+            streamer.end()
+
+    Thread(target=generate, daemon=True).start()
+    return StreamingResponse(streamer, media_type="text/plain")
+
+# Endpoint to pick one of a fixed set of labels (e.g. "[OK]" / "[NOT SUPPORTED]") in a single forward pass
+# every label is appended to the prompt and scored by the sum of the log-probabilities of its tokens
+@app.post('/classify', response_model=ClassifyResponse)
+def classify(request: ClassifyRequest):
+    require_model()
+    try:
+        image_key, image_inputs = get_image_inputs(request)
+        inputs = prepare_inputs(image_inputs, request.user_query)
+        prompt_ids = inputs['input_ids'][0]
+        label_ids = [processor.tokenizer(label, add_special_tokens=False, return_tensors="pt")['input_ids'][0] for label in request.labels]
+
+        # one row per label: prompt + label tokens (right padded)
+        max_length = len(prompt_ids) + max(len(ids) for ids in label_ids)
+        pad_token_id = processor.tokenizer.pad_token_id if processor.tokenizer.pad_token_id is not None else processor.tokenizer.eos_token_id
+        input_ids = torch.full((len(label_ids), max_length), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(label_ids), max_length), dtype=torch.long)
+        for row, ids in enumerate(label_ids):
+            input_ids[row, :len(prompt_ids) + len(ids)] = torch.cat([prompt_ids, ids])
+            attention_mask[row, :len(prompt_ids) + len(ids)] = 1
+        batch = {'input_ids': input_ids.to(device), 'attention_mask': attention_mask.to(device)}
+        if image_inputs is not None:
+            batch['pixel_values'] = inputs['pixel_values'].repeat(len(label_ids), *([1] * (inputs['pixel_values'].dim() - 1))).to(device)
+            batch['image_sizes'] = inputs['image_sizes'].repeat(len(label_ids), 1).to(device)
+
+        start_time = time.perf_counter()
+        with torch.no_grad():
+            logits = model(**batch).logits
+        metrics.observe('prefill_seconds', time.perf_counter() - start_time, endpoint='/classify')
+        metrics.increment('prompt_tokens', int(attention_mask.sum()), endpoint='/classify')
+
+        scores = {}
+        for row, (label, ids) in enumerate(zip(request.labels, label_ids)):
+            # the token at position t is predicted by the logits at position t-1 (only the label positions are normalized)
+            log_probs = torch.log_softmax(logits[row, len(prompt_ids) - 1:len(prompt_ids) - 1 + len(ids)].float(), dim=-1)
+            scores[label] = log_probs.gather(1, ids.to(log_probs.device)[:, None]).sum().item()
+        return ClassifyResponse(label=max(scores, key=scores.get), scores=scores)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# liveness: the server is up (also while the model is loading)
+@app.get('/health')
+def health():
+    status = 'error' if model_load_error is not None else ('ready' if model_ready.is_set() else 'loading')
+    return {'status': status, 'model_id': model_id, 'model_load_time_s': model_load_time}
+
+# readiness: 200 once the model is loaded, 503 before
+@app.get('/ready')
+def ready():
+    require_model()
+    return {'status': 'ready'}
+
+# Endpoint to monitor the request batcher (queue depth, average batch size, ...)
+@app.get('/batcher')
+def batcher_stats():
+    return batcher.stats()
+
+# Endpoint to monitor the prompt-prefix KV cache (hits, reused / prefilled tokens, ...)
+@app.get('/prefix_cache')
+def prefix_cache_stats():
+    return prefix_cache.stats()
+
+# Endpoint for Prometheus (text exposition format), `/metrics?format=json` returns the same values as json
+@app.get('/metrics')
+def server_metrics(format: str = 'prometheus'):
+    gauges = {
+        'queue_depth': batcher.queue_depth(),
+        'stored_images': len(image_store),
+        **{f'prefix_cache_{key}': value for key, value in prefix_cache.stats().items()},
+    }
+    if format == 'json':
+        return {**metrics.stats(), **gauges}
+    return PlainTextResponse(metrics.prometheus_text(gauges), media_type='text/plain; version=0.0.4')
+
 """
 To run the server, `uvicorn Phi3_Vision_Server:app --host 127.0.0.1 --port 8001`
+The batch size and wait window can be set with the environment variables PHI3V_MAX_BATCH_SIZE and PHI3V_MAX_WAIT_MS
 """
\ No newline at end of file
@@ -0,0 +1,37 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+"""
+                                Server-side Image Store
+
+Clients upload an image once (`/register_image`) and receive a content-hash handle. Subsequent `/predict` calls only
+send the handle and the server reuses the decoded / preprocessed image stored under it.
+The store holds at most `max_images` entries and evicts the least recently used one.
+"""
+class Image_Store():
+    def __init__(self, max_images=64):
+        self.max_images = max_images
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def image_handle(byte_data):
+        return hashlib.sha256(byte_data).hexdigest()
+
+    def get(self, handle):
+        with self.lock:
+            if handle not in self.images:
+                return None
+            self.images.move_to_end(handle)
+            return self.images[handle]
+
+    def put(self, handle, image):
+        with self.lock:
+            self.images[handle] = image
+            self.images.move_to_end(handle)
+            while len(self.images) > self.max_images:
+                self.images.popitem(last=False)
+
+    def __len__(self):
+        return len(self.images)
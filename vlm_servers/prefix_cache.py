@@ -0,0 +1,194 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+"""
+                                Prompt-Prefix KV Cache
+
+The agent sends the same image with prompts that share long prefixes (chat template + image tokens + instruction
+header of `answer_with_context_prompt` / `self_check`). The KV cache of every prompt that was prefilled is kept, and a
+new prompt reuses the cached entry that shares the longest prefix with it (cropped to the shared length), so the prefill
+of a follow-up call only processes the new suffix. Since the image tokens come right after the chat template, the
+vision encoder also runs only once per image.
+
+Entries are namespaced by the image hash (the image placeholder token ids are the same for every image).
+At most `max_entries` entries / `max_bytes` bytes of KV tensors are kept, the least recently used entry is evicted first.
+The KV cache is large (num_layers x 2 x num_kv_heads x head_dim x dtype size per token, ~393 KB per token for
+Phi-3-vision in bf16, see kv_bytes_per_token), so the budget is set in bytes of GPU memory. A lookup copies only the
+shared prefix of the entry (the copy is extended in place by the generation).
+Works with any causal LM whose forward accepts `past_key_values` (DynamicCache or legacy tuples).
+"""
+class Prefix_KV_Cache():
+    def __init__(self, max_entries=32, max_bytes=2 * 1024 ** 3):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # {(namespace, token_ids): (past_key_values, size in bytes)}
+        self.num_cached_tokens = 0
+        self.num_cached_bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.prefilled_tokens = 0
+
+    # returns (past_key_values cropped to the longest shared prefix, length of the shared prefix)
+    def lookup(self, namespace, token_ids):
+        best_key, best_length = None, 0
+        with self.lock:
+            for key in self.entries:
+                if key[0] != namespace:
+                    continue
+                length = common_prefix_length(key[1], token_ids)
+                if length > best_length:
+                    best_key, best_length = key, length
+            if best_key is None:
+                self.misses += 1
+                return None, 0
+            self.entries.move_to_end(best_key)
+            self.hits += 1
+            self.reused_tokens += best_length
+            past_key_values = self.entries[best_key][0]
+        return copy_prefix(past_key_values, best_length), best_length
+
+    def put(self, namespace, token_ids, past_key_values):
+        key = (namespace, tuple(token_ids))
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            num_bytes = kv_cache_bytes(past_key_values)
+            self.entries[key] = (past_key_values, num_bytes)
+            self.num_cached_tokens += len(token_ids)
+            self.num_cached_bytes += num_bytes
+            # an entry larger than the whole budget is not kept at all
+            while len(self.entries) > self.max_entries or (self.num_cached_bytes > self.max_bytes and len(self.entries) > 0):
+                evicted_key, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.num_cached_tokens -= len(evicted_key[1])
+                self.num_cached_bytes -= evicted_bytes
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'cached_tokens': self.num_cached_tokens,
+            'cached_bytes': self.num_cached_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'reused_tokens': self.reused_tokens,
+            'prefilled_tokens': self.prefilled_tokens,
+        }
+
+
+def common_prefix_length(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+def legacy_layers(past_key_values):
+    return past_key_values.to_legacy_cache() if hasattr(past_key_values, 'to_legacy_cache') else past_key_values
+
+# copy of the first `length` positions of the KV cache (same cache type as past_key_values)
+def copy_prefix(past_key_values, length):
+    layers = tuple(tuple(tensor[:, :, :length].clone() for tensor in layer) for layer in legacy_layers(past_key_values))
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return type(past_key_values).from_legacy_cache(layers)
+    return layers
+
+def kv_cache_bytes(past_key_values):
+    return sum(tensor.numel() * tensor.element_size() for layer in legacy_layers(past_key_values) for tensor in layer)
+
+# size of the KV cache of one token, from the model config (e.g. ~393 KB for Phi-3-vision in bf16)
+def kv_bytes_per_token(config, dtype):
+    head_dim = config.hidden_size // config.num_attention_heads
+    num_kv_heads = getattr(config, 'num_key_value_heads', None) or config.num_attention_heads
+    return config.num_hidden_layers * 2 * num_kv_heads * head_dim * torch.tensor([], dtype=dtype).element_size()
+
+
+# the KV cache of one prompt repeated for a batch of `batch_size` prompts
+def repeat_batch(past_key_values, batch_size):
+    layers = tuple(tuple(tensor.repeat(batch_size, 1, 1, 1) for tensor in layer) for layer in legacy_layers(past_key_values))
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return type(past_key_values).from_legacy_cache(layers)
+    return layers
+
+# KV cache of `token_ids` (a prompt prefix): the longest cached prefix is reused, only the rest is prefilled (and stored)
+def prefill_prefix(model, prefix_cache, namespace, token_ids, device, model_inputs=None):
+    past_key_values, cached_length = prefix_cache.lookup(namespace, token_ids)
+    if cached_length < len(token_ids):
+        with torch.no_grad():
+            outputs = model(
+                input_ids=torch.tensor([token_ids[cached_length:]], dtype=torch.long, device=device),
+                attention_mask=torch.ones((1, len(token_ids)), dtype=torch.long, device=device),
+                position_ids=torch.arange(cached_length, len(token_ids), device=device)[None],
+                past_key_values=past_key_values,
+                use_cache=True,
+                **(model_inputs or {}),
+            )
+        past_key_values = outputs.past_key_values
+        prefix_cache.prefilled_tokens += len(token_ids) - cached_length
+        prefix_cache.put(namespace, token_ids, copy_prefix(past_key_values, len(token_ids)))
+    return past_key_values
+
+
+"""
+Generate for a single (un-padded) prompt, reusing / extending the prefix cache
+ - the prompt minus its last token is prefilled (only the part not covered by the cache) and stored in the cache
+ - model.generate then starts from that cache and only processes the last prompt token before decoding
+`model_inputs` are extra forward inputs (e.g. pixel_values / image_sizes), they are only needed by the prefill
+"""
+def generate_with_prefix_cache(model, prefix_cache, namespace, input_ids, model_inputs=None, **generate_kwargs):
+    model_inputs = model_inputs or {}
+    token_ids = input_ids[0].tolist()
+    past_key_values = prefill_prefix(model, prefix_cache, namespace, token_ids[:-1], input_ids.device, model_inputs)
+    with torch.no_grad():
+        generate_ids = model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            **model_inputs,
+            **generate_kwargs,
+        )
+    return generate_ids[:, input_ids.shape[1]:] # remove input tokens
+
+
+"""
+Generate for a batch of prompts of the same namespace (image), reusing / extending the prefix cache
+ - the prefix shared by every prompt (at most the shortest prompt minus its last token) is prefilled once (only the part
+   not covered by the cache), stored in the cache and repeated for every prompt of the batch
+ - the suffixes are left-padded to the same length, so the padding sits between the shared prefix and the suffixes; it
+   is masked out by the attention mask (generate derives the position ids from the mask)
+`model_inputs` (e.g. pixel_values / image_sizes) are only passed to the prefill: the image tokens come right after the
+chat template, so they are part of the shared prefix
+Returns the generated token ids (batch_size x new tokens, padded with pad_token_id)
+"""
+def generate_batch_with_prefix_cache(model, prefix_cache, namespace, batch_input_ids, pad_token_id, model_inputs=None, **generate_kwargs):
+    device = batch_input_ids[0].device
+    batch_token_ids = [input_ids[0].tolist() for input_ids in batch_input_ids]
+    prefix_length = min(len(token_ids) for token_ids in batch_token_ids) - 1
+    for token_ids in batch_token_ids[1:]:
+        prefix_length = min(prefix_length, common_prefix_length(batch_token_ids[0], token_ids))
+    prefix_ids = batch_token_ids[0][:prefix_length]
+    past_key_values = prefill_prefix(model, prefix_cache, namespace, prefix_ids, device, model_inputs)
+
+    max_suffix_length = max(len(token_ids) for token_ids in batch_token_ids) - prefix_length
+    input_ids, attention_mask = [], []
+    for token_ids in batch_token_ids:
+        num_pad = max_suffix_length - (len(token_ids) - prefix_length)
+        input_ids.append(prefix_ids + [pad_token_id] * num_pad + token_ids[prefix_length:])
+        attention_mask.append([1] * prefix_length + [0] * num_pad + [1] * (len(token_ids) - prefix_length))
+    input_ids = torch.tensor(input_ids, dtype=torch.long, device=device)
+
+    with torch.no_grad():
+        generate_ids = model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.tensor(attention_mask, dtype=torch.long, device=device),
+            past_key_values=repeat_batch(past_key_values, len(batch_token_ids)) if past_key_values is not None else None,
+            pad_token_id=pad_token_id,
+            **generate_kwargs,
+        )
+    return generate_ids[:, input_ids.shape[1]:] # remove input tokens
@@ -0,0 +1,73 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+"""
+                                Dynamic Micro-Batching
+
+Requests coming from concurrent HTTP handlers are collected into a queue. A single worker thread waits for the first
+request, then keeps collecting more requests for at most `max_wait_ms` (or until `max_batch_size` requests are queued)
+and runs them all through `batch_fn` in one go. The outputs are demultiplexed back to the waiting callers.
+
+`batch_fn` takes a list of request payloads and must return a list of outputs of the same length (same order).
+It is model agnostic, so it can be exercised with any tiny stand-in model on CPU.
+"""
+class Request_Batcher():
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=10):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+
+        self.request_queue = queue.Queue()
+        self.batches_run = 0
+        self.requests_served = 0
+
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    # blocks the calling (HTTP handler) thread until the batch containing this request has been processed
+    def submit(self, payload):
+        future = Future()
+        self.request_queue.put((payload, future))
+        return future.result()
+
+    def queue_depth(self):
+        return self.request_queue.qsize()
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth(),
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait_ms,
+            'batches_run': self.batches_run,
+            'mean_batch_size': round(self.requests_served / self.batches_run, 2) if self.batches_run > 0 else 0.0,
+        }
+
+    def _collect_batch(self):
+        batch = [self.request_queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.request_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            payloads = [payload for payload, future in batch]
+            try:
+                outputs = self.batch_fn(payloads)
+                for (payload, future), output in zip(batch, outputs):
+                    future.set_result(output)
+            # a failing batch fails every request in it (the HTTP handlers turn this into a 500 error)
+            except Exception as e:
+                for payload, future in batch:
+                    future.set_exception(e)
+            self.batches_run += 1
+            self.requests_served += len(batch)
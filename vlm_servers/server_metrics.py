@@ -0,0 +1,127 @@
+import json
+import time
+import logging
+import threading
+from collections import defaultdict
+
+import torch
+from transformers import LogitsProcessor
+
+"""
+                                Server Metrics (`/metrics`)
+
+ - per endpoint: requests (by status code) and request latency
+ - per generation: total time, prefill time (prompt in -> first token), decode time (first -> last token), prompt /
+   generated tokens - measured with a Generation_Timer passed to generate as a logits processor, or marked by hand
+   (e.g. at the first streamed chunk). without a first-token mark only the total time is recorded
+ - gauges (queue depth, stored images, prefix cache, ...) are read when the metrics are rendered
+Rendered as Prometheus text, every generation is also logged as one structured (json) record on the
+`vlm_server.generation` logger.
+"""
+logger = logging.getLogger('vlm_server.generation')
+
+"""
+The first call of the logits processors happens right after the prefill forward pass, so the prefill time is measured
+without any change to the generation loop (the device is synchronized at that point and at the end only)
+Models whose generate wrapper drops the logits processors (MiniCPM's model.chat) call mark_first_token themselves.
+"""
+class Generation_Timer(LogitsProcessor):
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.first_token_time = None
+        self.end_time = None
+
+    def __call__(self, input_ids, scores):
+        if self.first_token_time is None:
+            if scores.is_cuda:
+                torch.cuda.synchronize(scores.device)
+            self.mark_first_token()
+        return scores
+
+    def mark_first_token(self):
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+
+    # returns (total time, prefill time, decode time) - prefill / decode are None if the first token was never marked
+    def finish(self):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.end_time = time.perf_counter()
+        if self.first_token_time is None:
+            return self.end_time - self.start_time, None, None
+        return self.end_time - self.start_time, self.first_token_time - self.start_time, self.end_time - self.first_token_time
+
+
+class Server_Metrics():
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float) # {(name, labels): value}
+        self.summaries = defaultdict(lambda: [0.0, 0]) # {(name, labels): [sum, count]}
+
+    def increment(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            summary = self.summaries[(name, tuple(sorted(labels.items())))]
+            summary[0] += value
+            summary[1] += 1
+
+    # one call per generate call (a batch counts once for the times, the tokens of every request are counted)
+    def record_generation(self, endpoint, timer, num_generated_tokens, num_prompt_tokens=None, batch_size=1):
+        generation_time, prefill_time, decode_time = timer.finish()
+        self.observe('generation_seconds', generation_time, endpoint=endpoint)
+        if prefill_time is not None:
+            self.observe('prefill_seconds', prefill_time, endpoint=endpoint)
+            self.observe('decode_seconds', decode_time, endpoint=endpoint)
+        self.observe('batch_size', batch_size, endpoint=endpoint)
+        self.increment('generated_tokens', num_generated_tokens, endpoint=endpoint)
+        if num_prompt_tokens is not None:
+            self.increment('prompt_tokens', num_prompt_tokens, endpoint=endpoint)
+        logger.info(json.dumps({
+            'endpoint': endpoint,
+            'batch_size': batch_size,
+            'prompt_tokens': num_prompt_tokens,
+            'generated_tokens': num_generated_tokens,
+            'generation_ms': round(1000 * generation_time, 2),
+            'prefill_ms': round(1000 * prefill_time, 2) if prefill_time is not None else None,
+            'decode_ms': round(1000 * decode_time, 2) if decode_time is not None else None,
+            'decode_tokens_per_second': round(num_generated_tokens / decode_time, 1) if decode_time else None,
+        }))
+
+    def stats(self):
+        with self.lock:
+            stats = {name + format_labels(labels): value for (name, labels), value in self.counters.items()}
+            stats.update({name + format_labels(labels): {'sum': round(total, 4), 'count': count} for (name, labels), (total, count) in self.summaries.items()})
+        return stats
+
+    # gauges = {name: value} of values read at render time
+    def prometheus_text(self, gauges=None):
+        lines = []
+        with self.lock:
+            for counter_name in sorted({name for name, labels in self.counters}):
+                lines.append(f"# TYPE {self.namespace}_{counter_name}_total counter")
+                lines += [f"{self.namespace}_{name}_total{format_labels(labels)} {value}" for (name, labels), value in self.counters.items() if name == counter_name]
+            for summary_name in sorted({name for name, labels in self.summaries}):
+                lines.append(f"# TYPE {self.namespace}_{summary_name} summary")
+                for (name, labels), (total, count) in self.summaries.items():
+                    if name == summary_name:
+                        lines.append(f"{self.namespace}_{name}_sum{format_labels(labels)} {total}")
+                        lines.append(f"{self.namespace}_{name}_count{format_labels(labels)} {count}")
+            # decode throughput over the whole lifetime of the server
+            throughput = [(labels, self.counters.get(('generated_tokens', labels), 0.0) / total) for (name, labels), (total, count) in self.summaries.items() if name == 'decode_seconds' and total > 0]
+            if len(throughput) > 0:
+                lines.append(f"# TYPE {self.namespace}_decode_tokens_per_second gauge")
+                lines += [f"{self.namespace}_decode_tokens_per_second{format_labels(labels)} {value}" for labels, value in throughput]
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE {self.namespace}_{name} gauge")
+            lines.append(f"{self.namespace}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
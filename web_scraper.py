@@ -1,16 +1,23 @@
 import time
 import requests
+from requests.adapters import HTTPAdapter
 import logging
-from bs4 import BeautifulSoup
+import threading
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, TimeoutError
+from html.parser import HTMLParser
 from typing import Dict
-from urllib.parse import quote, urlparse
+from urllib.parse import quote, urlparse, unquote
 
 # pip install google-image-source-search
 from google_img_source_search import ReverseImageSearcher
 
-from nltk.tokenize import sent_tokenize
 import json
 
+from scraper_cache import Disk_Cache
+from tracing import TRACER
+
 """
                                                 Image Search Tools
 
@@ -111,6 +118,7 @@ class GoogleReverseImageSearch:
 
     def _parse_search_results(self, html_content: str):
         try:
+            from bs4 import BeautifulSoup # deferred import (only needed for the results page of search tool 1)
             soup = BeautifulSoup(html_content, "html.parser")
             return soup.find_all('div', class_='g'), True
         except Exception as e:
@@ -128,89 +136,359 @@ class GoogleReverseImageSearch:
                                 Perform Reverse Image Search and Parse Web Page Contents
 """
 
+"""
+Event-based paragraph extractor (no parse tree is built)
+ - only the text inside <p> elements is kept, and only inside the article body container (id="mw-content-text"), its
+   end is found by counting the nesting of its tag (pages without this container, i.e. non-Wikipedia pages, keep all of
+   their paragraphs)
+ - citation markers (<sup class="reference">[5]</sup>, [citation needed], ...), <style> and <script> are dropped
+"""
+class Paragraph_Extractor(HTMLParser):
+    def __init__(self, content_container_id='mw-content-text'):
+        super().__init__()
+        self.content_container_id = content_container_id
+        self.paragraphs = []
+        self.content_start = None # index of the first paragraph inside the article body
+        self.content_end = None # index after the last paragraph inside the article body
+        self.container_tag = None # tag of the article body container, and its nesting depth while it is open
+        self.container_nesting = 0
+        self.paragraph_text = None # text pieces of the currently open paragraph
+        self.skip_tag = None
+        self.skip_nesting = 0
+
+    def handle_starttag(self, tag, attrs):
+        if self.skip_tag is not None:
+            if tag == self.skip_tag:
+                self.skip_nesting += 1
+            return
+        attrs = dict(attrs)
+        if self.content_start is None and attrs.get('id') == self.content_container_id:
+            self.close_paragraph()
+            self.content_start = len(self.paragraphs)
+            self.container_tag, self.container_nesting = tag, 0
+        if tag == self.container_tag and self.content_end is None:
+            self.container_nesting += 1
+        if tag in ('style', 'script') or (tag == 'sup' and any(name in (attrs.get('class') or '') for name in ('reference', 'noprint'))):
+            self.skip_tag, self.skip_nesting = tag, 1
+        elif tag == 'p':
+            self.close_paragraph() # a <p> implicitly closes the previous one
+            self.paragraph_text = []
+
+    def handle_endtag(self, tag):
+        if self.skip_tag is not None:
+            if tag == self.skip_tag:
+                self.skip_nesting -= 1
+                if self.skip_nesting == 0:
+                    self.skip_tag = None
+            return
+        if tag == 'p':
+            self.close_paragraph()
+        if tag == self.container_tag and self.content_end is None:
+            self.container_nesting -= 1
+            if self.container_nesting == 0:
+                self.close_paragraph()
+                self.content_end = len(self.paragraphs)
+
+    def handle_data(self, data):
+        if self.paragraph_text is not None and self.skip_tag is None:
+            self.paragraph_text.append(data)
+
+    def close_paragraph(self):
+        if self.paragraph_text is not None:
+            self.paragraphs.append(' '.join(''.join(self.paragraph_text).split()))
+            self.paragraph_text = None
+
+    def article_paragraphs(self):
+        self.close_paragraph()
+        return self.paragraphs[self.content_start or 0:self.content_end]
+
+
+#### Extract contents (text paragraphs) from the html of a Wikipedia page
+# defined at module level so that it can be run in a worker process
+# paragraphs longer than max_paragraph_chars are re-chunked into smaller contexts of roughly 3 sentences each, so that a
+# single paragraph does not take up most of the token budget of a VLM call (None keeps every paragraph whole)
+def parse_webpage_contents(html_content, title, url, max_paragraph_chars=None):
+
+    json_content = []
+    extractor = Paragraph_Extractor()
+    extractor.feed(html_content.decode('utf-8', errors='replace') if isinstance(html_content, bytes) else html_content)
+    extractor.close()
+
+    for content in extractor.article_paragraphs():
+
+        if len(content) < 100: # remove trivial paragraphs containing less than 100 characters
+            pass
+
+        elif max_paragraph_chars is None or len(content) <= max_paragraph_chars:
+            ## use the entire text paragraph as a context ###
+            json_content.append({
+                        'Title': title,
+                        'URL': url,
+                        'content': content
+                    })
+
+        else:
+            ## overlong paragraph - smaller contexts of roughly 3 sentences each ##
+            from nltk.tokenize import sent_tokenize # deferred import, only needed for overlong paragraphs
+            sentences = sent_tokenize(content)
+            chunks = [sentences[i:i + 3] for i in range(0, len(sentences), 3)] # split to smaller paragraphs of roughly 3 sentences
+            for chunk in chunks:
+                if len(chunk) > 0:
+                    chunk_content = ' '.join(chunk)
+                    json_content.append({
+                        'Title': title,
+                        'URL': url,
+                        'content': chunk_content
+                    })
+                else:
+                    pass
+
+    return json_content
+
+
+#### Reference implementation: full BeautifulSoup parse of the page (kept for benchmarks/benchmark_extraction.py)
+def parse_webpage_contents_with_soup(html_content, title, url):
+
+    from bs4 import BeautifulSoup
+    json_content = []
+    soup = BeautifulSoup(html_content, 'html.parser')
+    for element in soup.find_all(['p']):
+        content = element.get_text(strip=True)
+        if len(content) >= 100: # remove trivial paragraphs containing less than 100 characters
+            json_content.append({'Title': title, 'URL': url, 'content': content})
+    return json_content
+
+# the render view of a Wikipedia article contains only the article body (no navigation, sidebars, footers, ...)
+def lightweight_wikipedia_url(url):
+    parsed_url = urlparse(url)
+    if parsed_url.netloc.endswith("wikipedia.org") and parsed_url.path.startswith("/wiki/"):
+        return f"{parsed_url.scheme}://{parsed_url.netloc}/w/index.php?title={quote(unquote(parsed_url.path[len('/wiki/'):]))}&action=render"
+    return url
+
+
+# raised by Scraper.search_the_web when neither search tool found an English Wikipedia page for the image
+class No_Search_Results(Exception):
+    pass
+
+
+"""
+Web pages are downloaded concurrently over a pooled session (at most `max_fetch_workers` downloads in flight and at most
+`max_requests_per_host` per host) and parsed in a pool of `max_parse_workers` worker processes.
+"""
 class Scraper():
-    def __init__(self, ) -> None:
+    def __init__(self, max_fetch_workers=8, max_requests_per_host=4, max_parse_workers=2, search_deadline=30.0, prefetch_pages=True, cache_dir='.scraper_cache', cache_ttl=24 * 3600, lightweight_pages=True, max_paragraph_chars=1200, passage_store=None, bm25_index=None) -> None:
         self.search_tool_1 = GoogleReverseImageSearch()
         self.search_tool_2 = ReverseImageSearcher()
 
-    def get_search_result(self, image_url):
-        search_tool1_results = self.search_tool_1.response(query="", image_url=image_url) # returns a python list
-        search_tool2_results = self.search_tool_2.search(image_url) # returns a iterable object
+        # both search tools run concurrently, a tool that has not returned within `search_deadline` seconds is ignored
+        self.search_deadline = search_deadline
+        # start downloading the Wikipedia pages found by the faster tool while the slower tool is still searching
+        self.prefetch_pages = prefetch_pages
+        self.prefetch_pool = ThreadPoolExecutor(max_workers=max_fetch_workers)
+        self.prefetched_pages = {} # {url: future returning the page html}
+        self.prefetched_pages_lock = threading.Lock()
+
+        # search results and web pages are cached on disk (cache_dir=None disables the cache)
+        self.cache = Disk_Cache(cache_dir, ttl=cache_ttl) if cache_dir is not None else None
+
+        # download the render view of Wikipedia articles (article body only) instead of the full page
+        self.lightweight_pages = lightweight_pages
+
+        # paragraphs longer than this are re-chunked into contexts of roughly 3 sentences (None keeps whole paragraphs)
+        self.max_paragraph_chars = max_paragraph_chars
+
+        # (optional) persistent knowledge base - pages already in the store are never scraped again (see passage_store.py)
+        self.passage_store = passage_store
+        # (optional) BM25 index of every extracted passage, used by the Contriever_Model as a lexical prefilter (see bm25_index.py)
+        self.bm25_index = bm25_index
+
+        self.max_fetch_workers = max_fetch_workers
+        self.max_requests_per_host = max_requests_per_host
+        self.max_parse_workers = max_parse_workers
+
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=max_fetch_workers, pool_maxsize=max_fetch_workers))
+        self.session.mount('http://', HTTPAdapter(pool_connections=max_fetch_workers, pool_maxsize=max_fetch_workers))
+        self.host_semaphores = defaultdict(lambda: threading.Semaphore(self.max_requests_per_host))
+        self.host_semaphores_lock = threading.Lock()
+        # created lazily, the worker processes are reused across searches
+        self.parse_pool = None
+
+    #### Extract English-Wikipedia pages for info retrieval ####
+    # returns [(title, url), ...]
+    def filter_wikipedia_results(self, search_tool, search_results):
+        if search_tool == "search_tool_1":
+            search_items = [(search_item.get('title'), search_item.get('link')) for search_item in search_results]
+        else:
+            search_items = [(search_item.page_title, search_item.page_url) for search_item in search_results]
+        return [(title, url) for title, url in search_items if title and url and "Wikipedia" in title and "en.wikipedia.org" in url]
+
+    # search results are cached by image URL and (if provided) by the content hash of the image
+    # so the same image hosted under another URL is not searched again
+    def get_search_result(self, image_url, image_hash=None):
+        cache_keys = [f"search:{image_url}"] + ([f"search:{image_hash}"] if image_hash is not None else [])
+        if self.cache is not None:
+            for key in cache_keys:
+                cached = self.cache.get(key)
+                if cached is not None and cached.fresh:
+                    TRACER.increment('search_cache', result="hit")
+                    return json.loads(cached.value)
+        TRACER.increment('search_cache', result="miss")
+
+        filtered_results, complete = self.search_the_web(image_url)
+
+        # partial results (a tool failed or missed the deadline) are not cached, the next search tries both tools again
+        if self.cache is not None and complete:
+            for key in cache_keys:
+                self.cache.put(key, json.dumps(filtered_results).encode('utf-8'))
+        return filtered_results
 
+    # returns (filtered_results, complete) - complete is False if a search tool failed or missed the deadline
+    def search_the_web(self, image_url):
 
-        #### Extract English-Wikipedia pages for info retrieval ####
+        executor = ThreadPoolExecutor(max_workers=2)
+        futures = {
+            executor.submit(TRACER.wrap(self.search_tool_1.response, 'search_tool_1'), query="", image_url=image_url): "search_tool_1", # returns a python list
+            executor.submit(TRACER.wrap(lambda: list(self.search_tool_2.search(image_url)), 'search_tool_2')): "search_tool_2", # returns a iterable object
+        }
+
+        # results of each search tool are filtered as soon as the tool returns
+        wikipedia_results = {}
+        completed_tools = set()
+        try:
+            for future in as_completed(futures, timeout=self.search_deadline):
+                search_tool = futures[future]
+                try:
+                    search_results = future.result()
+                except Exception as e:
+                    logging.error(f"{search_tool} failed: {e}")
+                    continue
+                completed_tools.add(search_tool)
+                # search tool 1 returns a message string when no results were found
+                if not isinstance(search_results, list):
+                    continue
+                wikipedia_results[search_tool] = self.filter_wikipedia_results(search_tool, search_results)
+                if self.prefetch_pages:
+                    for title, url in wikipedia_results[search_tool]:
+                        self.prefetch_webpage(url)
+        except TimeoutError:
+            logging.warning(f"Reverse image search deadline of {self.search_deadline}s exceeded, using the results available so far.")
+        finally:
+            executor.shutdown(wait=False)
 
         filtered_results = {} # store Title + URL as a dictionary
         url_history = [] # to avoid redundancy between two search tools
         webpage_number = 0
 
-        for search_item in search_tool1_results:
-            if "Wikipedia" in search_item.get('title') and "en.wikipedia.org" in search_item.get('link'):
-                filtered_results[f"page_{webpage_number}"] = {
-                    "Title": search_item.get('title'),
-                    "URL": search_item.get('link')
-                }
-                url_history.append(search_item.get('link'))
-                webpage_number += 1
-
-        for search_item in search_tool2_results:
-            if "Wikipedia" in search_item.page_title and "en.wikipedia.org" in search_item.page_url and search_item.page_url not in url_history:
-                filtered_results[f"page_{webpage_number}"] = {
-                    "Title": search_item.page_title,
-                    "URL": search_item.page_url
-                }
-                url_history.append(search_item.page_url)
-                webpage_number += 1
-
-        assert len(filtered_results) != 0, "\n\tCannot find any English Wikipedia pages matching this search\n"
-        return filtered_results
-
-    def extract_webpage_contents(self, search_tool_results):
+        # merge in a fixed order (search tool 1 first) so that the page numbering does not depend on which tool finished first
+        for search_tool in ("search_tool_1", "search_tool_2"):
+            for title, url in wikipedia_results.get(search_tool, []):
+                if url not in url_history:
+                    filtered_results[f"page_{webpage_number}"] = {
+                        "Title": title,
+                        "URL": url
+                    }
+                    url_history.append(url)
+                    webpage_number += 1
+
+        if len(filtered_results) == 0:
+            raise No_Search_Results("\n\tCannot find any English Wikipedia pages matching this search\n")
+        return filtered_results, len(completed_tools) == len(futures)
+
+    # pages already in the passage store are never downloaded again (extract_webpage_contents reads them from the store)
+    def prefetch_webpage(self, url):
+        if self.passage_store is not None and self.passage_store.has_page(url):
+            return
+        with self.prefetched_pages_lock:
+            if url not in self.prefetched_pages:
+                self.prefetched_pages[url] = self.prefetch_pool.submit(TRACER.wrap(self.fetch_webpage), url)
+
+    def fetch_webpage(self, url):
+        with TRACER.span('fetch_webpage', url=url):
+            return self._fetch_webpage(url)
+
+    def _fetch_webpage(self, url):
+        cache_key = f"page:{url}"
+        cached = self.cache.get(cache_key) if self.cache is not None else None
+        if cached is not None and cached.fresh:
+            TRACER.increment('page_cache', result="hit")
+            return cached.value
+
+        # a stale page is revalidated with a conditional request (the server replies 304 if the page did not change)
+        headers = {}
+        if cached is not None and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached is not None and cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+
+        with self.host_semaphores_lock:
+            host_semaphore = self.host_semaphores[urlparse(url).netloc]
+        with host_semaphore:
+            response = self.session.get(lightweight_wikipedia_url(url) if self.lightweight_pages else url, timeout=5.0, headers=headers)
+
+        if response.status_code == 304 and cached is not None:
+            TRACER.increment('page_cache', result="revalidated")
+            self.cache.touch(cache_key)
+            return cached.value
+        TRACER.increment('page_cache', result="miss")
+        response.raise_for_status()
+        if self.cache is not None:
+            self.cache.put(cache_key, response.content, etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'))
+        return response.content
+
+    def extract_webpage_contents(self, search_tool_results, json_path=None):
+
+        #### Extract contents (text paragraphs) from Wikipedia pages and return them (optionally also saved to a JSON file at json_path).
+
+        if self.parse_pool is None and self.max_parse_workers > 0:
+            # the agent process already runs threads (prefetching, retriever loading, health checks), forking it could deadlock
+            # a worker - the workers are started from a clean forkserver process instead (spawn where forkserver is unavailable)
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self.parse_pool = ProcessPoolExecutor(max_workers=self.max_parse_workers, mp_context=multiprocessing.get_context(start_method))
+        pages = list(search_tool_results.values())
+
+        # pages downloaded while the search was still running are not fetched again
+        # (only the pages of this search are taken, prefetches of concurrent sessions stay in place)
+        with self.prefetched_pages_lock:
+            prefetched_pages = {page["URL"]: self.prefetched_pages.pop(page["URL"]) for page in pages if page["URL"] in self.prefetched_pages}
+
+        # a page is parsed (and indexed) as soon as its download finishes (overlaps with the remaining downloads)
+        def fetch_and_parse_and_index(page):
+            contents = fetch_and_parse(page)
+            if self.bm25_index is not None:
+                self.bm25_index.add_passages(contents)
+            return contents
+
+        def fetch_and_parse(page):
+            if self.passage_store is not None and self.passage_store.has_page(page["URL"]):
+                TRACER.increment('passage_store', result="hit")
+                return self.passage_store.get_passages(page["URL"])
+            if page["URL"] in prefetched_pages:
+                html_content = prefetched_pages[page["URL"]].result()
+            else:
+                html_content = self.fetch_webpage(page["URL"])
+            with TRACER.span('parse_webpage', url=page["URL"]):
+                if self.parse_pool is None:
+                    contents = parse_webpage_contents(html_content, page["Title"], page["URL"], self.max_paragraph_chars)
+                else:
+                    contents = self.parse_pool.submit(parse_webpage_contents, html_content, page["Title"], page["URL"], self.max_paragraph_chars).result()
+            if self.passage_store is not None:
+                return self.passage_store.add_page(page["URL"], page["Title"], [content['content'] for content in contents])
+            return contents
 
-        #### Extract contents (text paragraphs) from Wikipedia pages and save them to a JSON file.
+        with ThreadPoolExecutor(max_workers=self.max_fetch_workers) as executor:
+            futures = [executor.submit(TRACER.wrap(fetch_and_parse_and_index), page) for page in pages]
 
+        # a failing page is skipped instead of failing the whole search (page order of the search results is preserved)
         json_content = []
-
-        for key, value in search_tool_results.items():
-            title = value["Title"]
-            url = value["URL"]
-            response = requests.get(url, timeout=5.0)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.content, 'html.parser')
-
-            def parse_element(element):
-                if element.name == 'p': # text paragraphs
-                    content = element.get_text(strip=True)
-
-                    if len(content) < 100: # remove trivial paragraphs containing less than 100 characters
-                        pass
-
-                    else:
-                        ## use this if you want to use the entire text paragraph as a context ###
-                        json_content.append({
-                                    'Title': title,
-                                    'URL': url,
-                                    'content': content
-                                })
-                        
-                        ## use this if you want smaller contexts of roughly 3 sentences each ##
-                        # sentences = sent_tokenize(content)
-                        # chunks = [sentences[i:i + 3] for i in range(0, len(sentences), 3)] # split to smaller paragraphs of roughly 3 sentences
-                        # for chunk in chunks:
-                        #     if len(chunk) > 0:
-                        #         chunk_content = ' '.join(chunk)
-                        #         json_content.append({
-                        #             'Title': title,
-                        #             'URL': url,
-                        #             'content': chunk_content
-                        #         })
-                        #     else:
-                        #         pass
-
-            # Extract text paragraphs from the page
-            for element in soup.find_all(['p']): parse_element(element)
-
-        # Save contents to a JSON file named parsed_search_results.json
-        with open('parsed_search_results.json', 'w', encoding='utf-8') as file:
-            json.dump(json_content, file, ensure_ascii=False, indent=4)
-        file.close()
\ No newline at end of file
+        for page, future in zip(pages, futures):
+            try:
+                json_content.extend(future.result())
+            except Exception as e:
+                logging.error(f"Failed to extract contents from {page['URL']}: {e}")
+
+        # Save contents to a JSON file (e.g. parsed_search_results.json)
+        if json_path is not None:
+            with open(json_path, 'w', encoding='utf-8') as file:
+                json.dump(json_content, file, ensure_ascii=False, indent=4)
+        return json_content